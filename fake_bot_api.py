@@ -0,0 +1,175 @@
+import os
+import sys
+import tempfile
+import threading
+import time
+import types
+import uuid
+
+import telebot
+
+# Offline stand-in for telebot.TeleBot, used to test and benchmark the report fan-out.
+# python fake_bot_api.py [subs] [flood_every] - fan-out of a sample report to fake managers,
+# with flood_every > 0 every n-th call is answered with 429 like the real Bot API does.
+# python fake_bot_api.py replay "/start" "@id pass" ... - posts the texts as Telegram updates to the webhook
+# of server.py and prints the answers, subscriptions go to a temporary server.db.
+# python fake_bot_api.py chunks - sends a report with lone \r through /send_chunk, checks the archived copy.
+
+UPLOAD_SEC_PER_KB = 0.01
+UPLOAD_BASE_SEC = 0.3
+SEND_BY_FILE_ID_SEC = 0.1
+
+
+class FakeBot:
+    """Answers like the Bot API, sleeps like the network. Uploads cost more than file_id sends."""
+
+    def __init__(self, upload_base_sec: float = UPLOAD_BASE_SEC, send_by_file_id_sec: float = SEND_BY_FILE_ID_SEC,
+                 flood_every: int = 0, retry_after: int = 1):
+        self.upload_base_sec = upload_base_sec
+        self.send_by_file_id_sec = send_by_file_id_sec
+        self.flood_every = flood_every
+        self.retry_after = retry_after
+        self.requests = 0
+        self.calls = []
+        self.lock = threading.Lock()
+        self.message_id = 0
+
+    def _message(self, chat_id, **fields):
+        with self.lock:
+            self.message_id += 1
+            return types.SimpleNamespace(message_id=self.message_id, chat=types.SimpleNamespace(id=chat_id), **fields)
+
+    def _record(self, method: str, chat_id, payload):
+        with self.lock:
+            self.calls.append((method, chat_id, payload))
+
+    def _check_flood(self, method: str):
+        with self.lock:
+            self.requests += 1
+            flood = self.flood_every > 0 and self.requests % self.flood_every == 0
+        if flood:
+            self._record('429', None, method)
+            raise telebot.apihelper.ApiTelegramException(method, None, {
+                'ok': False, 'error_code': 429,
+                'description': f'Too Many Requests: retry after {self.retry_after}',
+                'parameters': {'retry_after': self.retry_after}})
+
+    def send_message(self, chat_id, text, **kwargs):
+        self._check_flood('sendMessage')
+        time.sleep(self.send_by_file_id_sec)
+        self._record('send_message', chat_id, text)
+        return self._message(chat_id, text=text)
+
+    def send_document(self, chat_id, document, caption=None, **kwargs):
+        self._check_flood('sendDocument')
+        if isinstance(document, str):   # file_id of an earlier upload
+            time.sleep(self.send_by_file_id_sec)
+            file_id = document
+            self._record('send_document', chat_id, file_id)
+        else:
+            data = document.read()
+            time.sleep(self.upload_base_sec + UPLOAD_SEC_PER_KB * len(data) / 1024)
+            file_id = f'fake-{uuid.uuid4().hex}'
+            self._record('upload_document', chat_id, len(data))
+        return self._message(chat_id, caption=caption, document=types.SimpleNamespace(file_id=file_id))
+
+    def count(self, method: str) -> int:
+        with self.lock:
+            return len([call for call in self.calls if call[0] == method])
+
+
+def bench_fanout(subs_count: int, flood_every: int = 0):
+    import server
+
+    reports = sorted(os.listdir('reports')) if os.path.isdir('reports') else []
+    if reports:
+        with open(os.path.join('reports', reports[0]), 'rb') as f:
+            data = f.read()
+    else:   # reports/ already moved into the archive
+        data = ('Сменный отчет ' * 4 + '\n').encode('utf-8') * 50
+    rest_id = 'bench'
+    with server.db_lock:
+        server.subs_index[rest_id] = set(range(1, subs_count + 1))
+
+    server.bot = FakeBot(flood_every=flood_every)
+    start = time.time()
+    all_sent, file_id = server.send_to_users(rest_id, 'bench', 'bench.txt', data, set())
+    took = time.time() - start
+    print(f'{subs_count} subs: {took:.2f} sec, all sent: {all_sent}, '
+          f'uploads: {server.bot.count("upload_document")}, file_id sends: {server.bot.count("send_document")}, '
+          f'429 answers: {server.bot.count("429")}')
+
+    serial = subs_count * (UPLOAD_BASE_SEC + UPLOAD_SEC_PER_KB * len(data) / 1024)
+    print(f'One upload per subscriber in a row would take about {serial:.2f} sec.')
+
+
+def make_update(update_id: int, chat_id: int, text: str, username: str = 'replay') -> dict:
+    user = {'id': chat_id, 'is_bot': False, 'first_name': username, 'username': username}
+    return {'update_id': update_id,
+            'message': {'message_id': update_id, 'date': int(time.time()), 'text': text, 'from': user,
+                        'chat': dict(user, type='private')}}
+
+
+def replay_updates(texts: list, chat_id: int = 1, timeout_sec: float = 30) -> list:
+    """Feeds texts through the webhook route of server.py, answers go to a FakeBot. Returns the answers."""
+    import server
+
+    server.STORE_FILE = os.path.join(tempfile.mkdtemp(), 'server.db')
+    server.open_store()
+    server.db = server.read_db()
+    server.rebuild_subs_index()
+    fake = FakeBot(send_by_file_id_sec=0.01)
+    server.bot.send_message = fake.send_message
+    server.bot.send_document = fake.send_document
+
+    client = server.app.test_client()
+    headers = {'X-Telegram-Bot-Api-Secret-Token': server.webhook_secret}
+    for update_id, text in enumerate(texts, 1):
+        start = time.time()
+        answered = len(fake.calls)
+        resp = client.post(server.WEBHOOK_PATH + server.webhook_secret, json=make_update(update_id, chat_id, text),
+                           headers=headers)
+        while len(fake.calls) == answered and time.time() - start < timeout_sec:
+            time.sleep(0.01)
+        print(f'> {text} [{resp.status_code}] {time.time() - start:.2f} sec')
+        for method, to_chat, payload in fake.calls[answered:]:
+            print(f'< {payload}')
+    return [payload for method, to_chat, payload in fake.calls]
+
+
+def check_chunks(text: str = None, chunk_bytes: int = 4000) -> bool:
+    """Sends text in iter_chunks() pieces of the client to /send_chunk, True if the archive has it unchanged."""
+    import main
+    import server
+
+    tmp_dir = tempfile.mkdtemp()
+    server.STORE_FILE = os.path.join(tmp_dir, 'server.db')
+    server.ARCHIVE_DIR = os.path.join(tmp_dir, 'archive')
+    server.INCOMING_DIR = os.path.join(tmp_dir, 'incoming')
+    server.open_store()
+    if text is None:
+        text = 'line one\rstill one\n' * 3000 + 'Сменный отчет\r\n' * 100 + 'no line end'
+    rest_id, rep_title = 'chunks', 'check chunks'
+    chunks = list(main.iter_chunks(text, chunk_bytes))
+    report_id = main.report_digest(rest_id, rep_title, text)
+
+    client = server.app.test_client()
+    for seq, chunk in enumerate(chunks):
+        resp = client.post('/send_chunk', json={'rest_id': rest_id, 'report_id': report_id, 'rep_title': rep_title,
+                                                'seq': seq, 'total': len(chunks), 'data': chunk})
+        if resp.status_code != 200:
+            print(f'Chunk {seq} of {len(chunks)}: [{resp.status_code}] {resp.get_data(as_text=True)[:200]}')
+            return False
+    archive_id = server.get_store_db().execute('SELECT MAX(id) FROM archive').fetchone()[0]
+    same = ''.join(chunks) == text and server.read_archived(archive_id)[1].decode('utf-8') == text
+    print(f'{len(chunks)} chunks, archived report is {"the same" if same else "DIFFERENT"}')
+    return same
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'replay':
+        replay_updates(sys.argv[2:] or ['/start'])
+    elif len(sys.argv) > 1 and sys.argv[1] == 'chunks':
+        sys.exit(0 if check_chunks() else 1)
+    else:
+        bench_fanout(int(sys.argv[1]) if len(sys.argv) > 1 else 20, int(sys.argv[2]) if len(sys.argv) > 2 else 0)
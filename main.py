@@ -1,18 +1,64 @@
 import base64
+import codecs
 import datetime
+import difflib
+import errno
+import gzip
+import hashlib
+import itertools
+import mmap
+import multiprocessing
 import os
 import random
+import re
+import shutil
+import sqlite3
 import requests
+import requests.adapters
 import logging
 import sys
 import json
 import threading
 import time
 import traceback
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+try:
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+except ImportError:
+    FileSystemEventHandler = object
+    Observer = None
 
 
 CONFIG_FILE = "config.json"
 LOGS_FILE = "logs.txt"
+SPOOL_INDEX_FILE = "spool_index.json"
+SPOOL_HASH_BLOCK = 64 * 1024
+SPOOL_ENCODINGS = ['cp1251', 'utf-8']
+OUTBOX_FILE = "outbox.db"
+PARKED_DIR = "parked"   # Reports the server will never take (too large), kept for a person to look at
+OUTBOX_RETRY_MAX_SEC = 60 * 60
+OUTBOX_SEND_BATCH = 500
+SEND_BATCH_SIZE = 50
+BATCH_MAX_REPORTS = 100   # Limit of servers from before max_batch_reports in /caps
+BATCH_ENVELOPE_BYTES = 1024   # rest_id and the list around the reports in a batch body
+SEND_WORKERS = 4
+COMPRESS_MIN_BYTES = 1024
+CHUNK_BYTES = 32 * 1000   # Larger reports go to /send_chunk in pieces cut on line boundaries
+DELTA_MIN_BYTES = 512
+OPEN_REPORT_WAIT_SEC = 5 * 60   # A report without its end marker is sent up to EOF once the file is this old
+WATCH_RETRY_SEC = 10   # A spool file that could not be read (still locked by the driver) is tried again after this
+CATCHUP_MIN_FILES = 20   # A backlog this big is read by a process pool, one spool file per task
+DELTA_MAX_SHARE = 0.7   # A diff is sent only when it is smaller than this share of the report
+NEED_FULL = 'need_full'
+MAX_RESPONSE_BYTES = 1024 * 1024
+SEND_TIMEOUT = (10, 120)   # connect, read
+ADDR_TIMEOUT = (5, 10)
+ADDR_TTL_SEC = 10 * 60
+ADDR_RETRY_SEC = 30
+ADDR_BREAKER_FAILS = 3
+ADDR_BREAKER_SEC = 5 * 60
 LOGS_MAX_SIZE_MB = 20
 REST_ID_LEN = 8
 REP_TITLE_LEN = 25
@@ -65,86 +111,399 @@ def cleanup_logs_if_need():
 
 
 def check_dirs_files():
-    dirs = ['tosend', 'deleted']
+    dirs = ['deleted', PARKED_DIR]
     for dir in dirs:
         if not os.path.isdir(dir):
             logger.info(f'Creating directory "{dir}" ')
             os.makedirs(dir)
 
 
-def get_bot_server_addr(log_everything: bool = False) -> str:
+addr_state = {'addr': None, 'expires': 0, 'fails': 0, 'breaker_until': 0}
+addr_lock = threading.Lock()
+addr_refresh = threading.Event()
+
+
+def resolve_bot_server_addr(log_everything: bool = False) -> str:
     global config
     get_addr_addr = config['get_addr']
-    def_addr_addr = config['default_addr']
     headers = {
         'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_10_1) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/39.0.2171.95 Safari/537.36'}
+    resp = requests.get(get_addr_addr, headers=headers, timeout=ADDR_TIMEOUT)
+    recv_addr = resp.text.strip()
+    if (len(recv_addr.split('\n')) > 1 or len(recv_addr.split('.')) != 4):
+        raise Exception(f'{recv_addr} is not an ip or domain addr.')
+    if log_everything:
+        logger.info(f'Will use received ip: {recv_addr}')
+    return recv_addr
+
+
+def refresh_bot_server_addr(log_everything: bool = False):
     try:
-        resp = requests.get(get_addr_addr, headers=headers)
-        recv_addr = resp.text.strip()
-        if (len(recv_addr.split('\n')) > 1 or len(recv_addr.split('.')) != 4):
-            raise Exception(f'{recv_addr} is not an ip or domain addr.')
-        if log_everything:
-            logger.info(f'Will use received ip: {recv_addr}')
-        return recv_addr
+        recv_addr = resolve_bot_server_addr(log_everything)
+        with addr_lock:
+            addr_state.update({'addr': recv_addr, 'expires': time.time() + ADDR_TTL_SEC,
+                               'fails': 0, 'breaker_until': 0})
     except Exception as e1:
-        err = f'get_bot_server_addr() error while connecting to {get_addr_addr}: {e1}'
+        err = f'refresh_bot_server_addr() error while connecting to {config["get_addr"]}: {e1}'
         print(err)
+        with addr_lock:
+            addr_state['fails'] += 1
+            addr_state['expires'] = time.time() + ADDR_RETRY_SEC
+            if addr_state['fails'] >= ADDR_BREAKER_FAILS:
+                # get_addr looks down, use default_addr and stop asking it for a while
+                addr_state['breaker_until'] = time.time() + ADDR_BREAKER_SEC
+                addr_state['expires'] = addr_state['breaker_until']
+                log_everything = True
         if log_everything:
             logger.error(err)
-            logger.error(traceback.format_exc())
-            logger.info(f'Will use default_addr: {def_addr_addr}')
-        return def_addr_addr
-
-
-def get_report_by_markers(marker: list, lines: list) -> list:
-    rep_lines = []
-    print(lines)
-    mark_name = marker[0]
-    mark_start = marker[1]
-    mark_end = marker[2]
-    if len(mark_end) == 0:
-        mark_end = "$default"
-
-    print(f'Marker start:{mark_start}; Marker end:{mark_end};')
-    rep_found = False
-    for line in lines:
-        line = line.replace('\n', '')
-        if not rep_found:   # Если не наткнулись на начало отчета
-            if mark_start in line:
-                rep_name_line = mark_name
-                rep_lines.append(rep_name_line)
-                if config['include_markers'] == True:
-                    rep_lines.append(line)
-                print(f'Found START match in line:{line}')
-                rep_found = True
-            else:
-                print(f'do not match:"{line}"')
-        else:   # Если уже читаем отчет
-            if mark_end != '$default' and mark_end in line:
-                print(f'Found END match in line:{line}')
-                if config['include_markers'] == True:
-                    rep_lines.append(line)
-                break
+            logger.info(f'Will use default_addr: {config["default_addr"]} until get_addr answers.')
+
+
+def get_bot_server_addr() -> str:
+    """Cached address, never blocks, refreshing happens in addr_refresh_loop()."""
+    with addr_lock:
+        if addr_state['expires'] <= time.time():
+            addr_refresh.set()
+        if addr_state['addr'] and addr_state['breaker_until'] <= time.time():
+            return addr_state['addr']
+    return config['default_addr']
+
+
+def invalidate_bot_server_addr():
+    """A send failed, ask get_addr again before the TTL runs out."""
+    with addr_lock:
+        if addr_state['breaker_until'] > time.time():
+            return
+        addr_state['expires'] = 0
+    addr_refresh.set()
+
+
+def addr_refresh_loop():
+    while True:
+        with addr_lock:
+            wait_sec = addr_state['expires'] - time.time()
+        if wait_sec > 0:
+            addr_refresh.wait(wait_sec)
+            addr_refresh.clear()
+            with addr_lock:
+                if addr_state['expires'] > time.time():
+                    continue   # Woken up by a reader that saw a fresh address
+        refresh_bot_server_addr()
+
+
+def build_marker_engine(markers: list, encoding: str) -> dict:
+    """All start/end markers of all reports folded into one compiled byte alternation.
+
+    The regex only finds lines holding some marker, the few lines it hits are then
+    checked marker by marker, so overlapping markers still work.
+    """
+    patterns = set()
+    encoded = []
+    for marker in markers:
+        mark_start = marker[1].encode(encoding)
+        mark_end = marker[2].encode(encoding)
+        encoded.append((marker[0], mark_start, mark_end))
+        patterns.add(mark_start)
+        if len(mark_end) > 0:
+            patterns.add(mark_end)
+    alternation = b'|'.join([re.escape(p) for p in sorted(patterns, key=len, reverse=True)])
+    logger.info(f'Marker engine built for {len(markers)} markers, encoding {encoding}.')
+    return {'markers': encoded, 'regex': re.compile(alternation), 'encoding': encoding}
+
+
+def build_marker_engines(markers: list, encoding: str = '') -> dict:
+    """One engine per candidate encoding, markers are encoded once here and matched as bytes."""
+    encodings = list(SPOOL_ENCODINGS)
+    if encoding and encoding not in encodings:
+        encodings.append(encoding)
+    return {encoding: build_marker_engine(markers, encoding) for encoding in encodings}
+
 
-            rep_lines.append(line)
+def get_spool_dirs() -> list:
+    """Printer folders from "printer_dirs", each with its own markers and encoding, or the single "printer_dir".
 
-    # print(f'Ret report:{rep_lines}')
-    return rep_lines
+    An entry of printer_dirs is a path or {"path", "markers", "encoding"}, missing keys come from the top level.
+    """
+    entries = config.get("printer_dirs") or [config["printer_dir"]]
+    spool_dirs = []
+    for entry in entries:
+        if isinstance(entry, str):
+            entry = {"path": entry}
+        markers = entry.get("markers", config.get("markers", []))
+        encoding = entry.get("encoding", config.get("encoding", ''))
+        spool_dirs.append({'path': entry["path"], 'encoding': encoding,
+                           'engines': build_marker_engines(markers, encoding)})
+    return spool_dirs
+
+
+dir_encodings = {}   # printer dir -> detected encoding
+
+
+NON_ASCII_RE = re.compile(rb'[\x80-\xff]')
+
+
+def detect_encoding(buf) -> str:
+    """utf-8 or cp1251 judging by the block from the first non-ascii byte, None while the data is plain ascii.
+
+    A day log often starts with ascii only, the Cyrillic may come anywhere later.
+    """
+    match = NON_ASCII_RE.search(buf)
+    if not match:
+        return None
+    # Ascii before it, so the match is the first byte of a utf-8 sequence if the file is utf-8
+    sample = buf[match.start():match.start() + SPOOL_HASH_BLOCK]
+    try:
+        # final=False, the block may end in the middle of a utf-8 sequence
+        codecs.getincrementaldecoder('utf-8')().decode(sample, final=False)
+        return 'utf-8'
+    except UnicodeDecodeError:
+        return 'cp1251'
+
+
+def get_dir_encoding(spool_dir: dict) -> str:
+    """Configured or already detected encoding of the printer folder, None while unknown."""
+    return spool_dir['encoding'] or dir_encodings.get(spool_dir['path'])
+
+
+def remember_dir_encoding(spool_dir: dict, encoding: str):
+    if encoding and not get_dir_encoding(spool_dir):
+        dir_encodings[spool_dir['path']] = encoding
+        logger.info(f'Detected encoding {encoding} for {spool_dir["path"]}')
+
+
+def get_span_lines(engine: dict, buf, start: int, end: int) -> list:
+    if end <= start:
+        return []
+    text = buf[start:end].decode(engine['encoding'], errors='replace')
+    if text.endswith('\n'):
+        text = text[:-1]
+    if text.endswith('\r'):
+        text = text[:-1]
+    return text.replace('\r\n', '\n').split('\n')
+
+
+def find_report_spans(engine: dict, buf, start: int = 0, include_markers: bool = None) -> list:
+    """Single pass over buf from start, returns [(marker_pos, span_start, span_end, complete), ...] in file order.
+
+    buf is bytes or an mmap, only the lines holding markers are copied out of it.
+    Every occurrence of a marker gives its own span. complete is False for a span that runs to the end
+    of buf because its end marker has not come yet, a marker without an end always runs to the end.
+    """
+    markers = engine['markers']
+    if include_markers is None:
+        include_markers = config['include_markers'] == True
+    buf_len = len(buf)
+    open_reps = {}   # marker pos -> index of its span in spans
+    spans = []
+    last_line_start = -1
+    for match in engine['regex'].finditer(buf, start):
+        line_start = buf.rfind(b'\n', start, match.start()) + 1 or start
+        if line_start == last_line_start:
+            continue   # Second marker on a line that was already checked
+        last_line_start = line_start
+        line_end = buf.find(b'\n', match.end())
+        if line_end == -1:
+            line_end = buf_len
+        line = buf[line_start:line_end]
+
+        for pos, (mark_name, mark_start, mark_end) in enumerate(markers):
+            rep = open_reps.get(pos)
+            if rep is None:   # Если не наткнулись на начало отчета
+                if mark_start in line:
+                    print(f'Found START match of {mark_name} at {line_start}')
+                    span_start = line_start if include_markers else min(line_end + 1, buf_len)
+                    open_reps[pos] = len(spans)
+                    spans.append([pos, span_start, buf_len, len(mark_end) == 0])
+            elif len(mark_end) > 0 and mark_end in line:   # Конец отчета
+                print(f'Found END match of {mark_name} at {line_start}')
+                spans[rep][2] = line_end if include_markers else line_start
+                spans[rep][3] = True
+                del open_reps[pos]
+
+    return [tuple(span) for span in spans]
+
+
+def extract_reports(engine: dict, buf, spans: list):
+    """Yields (marker_pos, rep_lines) per span of find_report_spans(), the first line is the marker name.
+
+    Spans are decoded one at a time, so memory is bounded by the largest report.
+    """
+    for pos, span_start, span_end, complete in spans:
+        yield pos, [engine['markers'][pos][0]] + get_span_lines(engine, buf, span_start, span_end)
+
+
+def copy_file_fast(src: str, dst: str):
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        if hasattr(os, 'copy_file_range'):
+            try:
+                size = os.fstat(fsrc.fileno()).st_size
+                copied = 0
+                while copied < size:
+                    n = os.copy_file_range(fsrc.fileno(), fdst.fileno(), size - copied)
+                    if n == 0:
+                        break
+                    copied += n
+                return
+            except OSError:
+                fsrc.seek(0)
+                fdst.seek(0)
+                fdst.truncate()
+        shutil.copyfileobj(fsrc, fdst, 1024 * 1024)
 
 
 def copy_and_delete_original(tmp_name, fpath) -> str:
     print(f'copy_and_delete_original() called:{fpath}')
     path_orig_copy = os.path.join('deleted', tmp_name)
-    open(path_orig_copy, 'wb').write(open(fpath, 'rb').read())  # Copy
+    try:
+        os.replace(fpath, path_orig_copy)
+        return path_orig_copy
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+    # printer_dir is on another disk, copy without reading the file into memory.
+    copy_file_fast(fpath, path_orig_copy)
     os.remove(fpath)
+    return path_orig_copy
+
+
+outbox_local = threading.local()
+outbox_wakeup = threading.Event()
+
+
+def get_outbox_db() -> sqlite3.Connection:
+    """Connection of the calling thread, WAL lets the scanner write while the sender reads."""
+    db = getattr(outbox_local, 'db', None)
+    if db is None:
+        db = sqlite3.connect(OUTBOX_FILE, timeout=30, isolation_level=None)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')   # fsync on checkpoints, not on every report
+        outbox_local.db = db
+    return db
+
+
+def open_outbox():
+    db = get_outbox_db()
+    db.execute('''CREATE TABLE IF NOT EXISTS outbox (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT NOT NULL,
+        rep_title TEXT NOT NULL,
+        rep_text TEXT NOT NULL,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        next_try REAL NOT NULL,
+        last_error TEXT,
+        grp TEXT NOT NULL DEFAULT '')''')
+    columns = [row[1] for row in db.execute('PRAGMA table_info(outbox)')]
+    if 'grp' not in columns:   # outbox.db from before the concurrent sender
+        db.execute("ALTER TABLE outbox ADD COLUMN grp TEXT NOT NULL DEFAULT ''")
+    db.execute('CREATE INDEX IF NOT EXISTS outbox_next_try ON outbox (next_try)')
+    db.execute('CREATE INDEX IF NOT EXISTS outbox_grp ON outbox (grp, id)')
+    db.execute('''CREATE TABLE IF NOT EXISTS bases (
+        rep_title TEXT PRIMARY KEY,
+        digest TEXT NOT NULL,
+        rep_text TEXT NOT NULL)''')
+    migrate_tosend_folder()
+    count = db.execute('SELECT COUNT(*) FROM outbox').fetchone()[0]
+    logger.info(f'open_outbox() finished. {count} reports waiting.')
 
 
-def save_report_tosend_folder(tmp_name, rep_lines: list):
+def split_report(data: str) -> tuple:
+    nl_pos = data.find('\n')
+    rep_title = data[0:nl_pos]
+    rep_data = data[data.find('\n'):]
+    return rep_title, rep_data
+
+
+def outbox_put(name: str, rep_title: str, rep_text: str):
+    """name is rep<N>-<letter>[-<part>], reports sharing rep<N> come from one spool file and keep their order."""
+    grp = name.split('-')[0]
+    get_outbox_db().execute('INSERT INTO outbox (name, rep_title, rep_text, next_try, grp) VALUES (?, ?, ?, ?, ?)',
+                            (name, rep_title, rep_text, time.time(), grp))
+    outbox_wakeup.set()
+
+
+def outbox_due(limit: int) -> list:
+    return get_outbox_db().execute(
+        'SELECT id, name, rep_title, rep_text, attempts, grp FROM outbox WHERE next_try <= ? ORDER BY id LIMIT ?',
+        (time.time(), limit)).fetchall()
+
+
+def outbox_done(rep_id: int):
+    get_outbox_db().execute('DELETE FROM outbox WHERE id = ?', (rep_id,))
+
+
+def get_retry_delay(attempts: int) -> float:
+    """Exponential backoff from sleep_send_sec with jitter, so a backlog does not retry in lockstep."""
+    delay = min(OUTBOX_RETRY_MAX_SEC, config["sleep_send_sec"] * 2 ** min(attempts, 16))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def outbox_retry(rep_id: int, attempts: int, error: str) -> float:
+    """Never lets a report become due before an earlier report of the same spool file."""
+    delay = get_retry_delay(attempts)
+    db = get_outbox_db()
+    db.execute('''UPDATE outbox SET attempts = ?, last_error = ?, next_try = MAX(?, COALESCE(
+        (SELECT MAX(o.next_try) FROM outbox o WHERE o.grp = outbox.grp AND o.id < outbox.id), 0))
+        WHERE id = ?''', (attempts + 1, error, time.time() + delay, rep_id))
+    db.execute('''UPDATE outbox SET next_try = (SELECT next_try FROM outbox WHERE id = ?)
+        WHERE grp = (SELECT grp FROM outbox WHERE id = ?) AND id > ?
+        AND next_try < (SELECT next_try FROM outbox WHERE id = ?)''', (rep_id, rep_id, rep_id, rep_id))
+    logger.info(f'Report {rep_id} will be retried in {int(delay)} sec. (attempt {attempts + 1})')
+    return delay
+
+
+def outbox_park(row: tuple, error: str):
+    """Takes a report the server refuses for good out of the outbox, its text goes to PARKED_DIR."""
+    rep_id, name, rep_title, rep_text, attempts, grp = row
+    os.makedirs(PARKED_DIR, exist_ok=True)
+    path = os.path.join(PARKED_DIR, f'{name}.txt')
+    with open(path, 'w', encoding='utf-8', newline='') as f:
+        f.write(rep_title + rep_text)   # As split_report() found it
+    outbox_done(rep_id)
+    logger.error(f'Report {rep_title} ({rep_id}) parked in {path}: {error}')
+
+
+def outbox_fail_due(error: str):
+    """Server is unreachable, every report due now backs off."""
+    due = get_outbox_db().execute('SELECT id, attempts FROM outbox WHERE next_try <= ? ORDER BY id',
+                                  (time.time(),)).fetchall()
+    for rep_id, attempts in due:
+        outbox_retry(rep_id, attempts, error)
+
+
+def outbox_next_wait(max_wait: float) -> float:
+    next_try = get_outbox_db().execute('SELECT MIN(next_try) FROM outbox').fetchone()[0]
+    if next_try is None:
+        return max_wait
+    return min(max_wait, max(0, next_try - time.time()))
+
+
+def migrate_tosend_folder():
+    """Moves reports left in the old tosend/ folder into the outbox."""
+    tosend_dir = 'tosend'
+    if not os.path.isdir(tosend_dir):
+        return
+    for file in sorted(os.listdir(tosend_dir)):
+        fpath = os.path.join(tosend_dir, file)
+        if os.path.isdir(fpath) or file == ".DS_Store":
+            continue
+        with open(fpath, 'rb') as f:
+            raw = f.read()
+        try:
+            data = raw.decode('utf-8')
+        except UnicodeDecodeError:
+            data = raw.decode('cp1251', errors='replace')
+        rep_title, rep_text = split_report(data)
+        outbox_put(os.path.splitext(file)[0], rep_title, rep_text)
+        os.remove(fpath)
+        logger.info(f'migrate_tosend_folder() moved {fpath} to the outbox.')
+
+
+def save_report_to_outbox(tmp_name, rep_lines: list):
     rep_plain_text = '\n'.join([i for i in rep_lines[0:]])
-    path = os.path.join('tosend', f'{tmp_name}.txt')
     logger.info(f'Following data prepared for sending:\n{rep_plain_text}')
-    with open(path, 'w') as f:
-        f.write(rep_plain_text)
+    rep_title, rep_text = split_report(rep_plain_text)
+    outbox_put(tmp_name, rep_title, rep_text)
+
 
 def get_letter(pos: int):
     letters = 'abcdefghlmn'
@@ -153,42 +512,274 @@ def get_letter(pos: int):
         ret += letters[int(let):int(let)+1]
     return ret
 
-def check_for_reports_loop():
-    while True:
-        print('check_for_reports_loop() invoked')
+def list_spool_files(printer_dir: str) -> list:
+    files = []
+    for file in os.listdir(printer_dir):
+        fpath = os.path.join(printer_dir, file)
+        if not os.path.isdir(fpath) and file != ".DS_Store":
+            files.append(fpath)
+    return files
+
+
+spool_index = {}   # path -> {"ino", "size", "mtime_ns", "hash", "offset"} of files without reports
+spool_index_lock = threading.Lock()
+spool_index_save_lock = threading.Lock()
+spool_index_dirty = False
+
+
+def load_spool_index():
+    global spool_index
+    if not os.path.isfile(SPOOL_INDEX_FILE):
+        return
+    try:
+        with open(SPOOL_INDEX_FILE, 'r') as f:
+            spool_index = json.loads(f.read())
+        logger.info(f'load_spool_index() finished. {len(spool_index)} known spool files.')
+    except Exception as e:
+        logger.error(f'load_spool_index() error: {traceback.format_exc()}, starting with empty index.')
+        spool_index = {}
+
+
+def save_spool_index():
+    """Every printer folder worker saves the shared index, one at a time."""
+    global spool_index_dirty
+    with spool_index_save_lock:
+        with spool_index_lock:
+            if not spool_index_dirty:
+                return
+            data = json.dumps(spool_index)
+            spool_index_dirty = False
+        tmp_path = SPOOL_INDEX_FILE + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(data)
+        os.replace(tmp_path, SPOOL_INDEX_FILE)
+
+
+def prune_spool_index(printer_dir: str, files: list):
+    """Forgets files of printer_dir that are gone, entries of other printer folders are left alone."""
+    global spool_index_dirty
+    alive = set(files)
+    dir_name = os.path.dirname(os.path.join(printer_dir, ''))
+    with spool_index_lock:
+        for path in list(spool_index.keys()):
+            if os.path.dirname(path) == dir_name and path not in alive:
+                del spool_index[path]
+                spool_index_dirty = True
+
+
+def get_prefix_hash(f, offset: int) -> str:
+    """Hash of the first and last blocks before offset, enough to notice a rewritten file."""
+    h = hashlib.sha1()
+    f.seek(0)
+    h.update(f.read(min(offset, SPOOL_HASH_BLOCK)))
+    if offset > SPOOL_HASH_BLOCK:
+        f.seek(max(SPOOL_HASH_BLOCK, offset - SPOOL_HASH_BLOCK))
+        h.update(f.read(offset - f.tell()))
+    return h.hexdigest()
+
+
+def get_scan_offset(f, file: str, st) -> int:
+    """Where to start reading file, None if it was already classified as having no reports."""
+    with spool_index_lock:
+        entry = spool_index.get(file)
+    if not entry:
+        return 0
+    if (entry['ino'], entry['size'], entry['mtime_ns']) == (st.st_ino, st.st_size, st.st_mtime_ns):
+        return None
+    if entry['ino'] == st.st_ino and st.st_size > entry['size'] \
+            and get_prefix_hash(f, entry['offset']) == entry['hash']:
+        return entry['offset']   # File only grew, the old part has no markers
+    return 0
+
+
+def get_file_offset(file: str) -> int:
+    """Where to start reading file, None if nothing changed since it was found to have no reports."""
+    with open(file, 'rb') as f:
+        return get_scan_offset(f, file, os.fstat(f.fileno()))
+
+
+def scan_spool_file(file: str, offset: int, engines: dict, encoding: str, include_markers: bool,
+                    open_wait_sec: float, put_report) -> dict:
+    """Reads the reports of file from offset, does not touch config, so it also runs in catch-up processes.
+
+    put_report(rep_lines) gets the reports one at a time in file order while the file is mapped,
+    so memory stays bounded by the largest report. encoding is None when the folder encoding
+    is not known yet, it is detected from the file then. While a report has no end marker yet and
+    the file changed less than open_wait_sec ago, nothing is put and result['unfinished'] is True:
+    the driver may only have paused in the middle of the job.
+    """
+    found = 0
+    unfinished = False
+    detected = None
+    with open(file, 'rb') as f:
+        st = os.fstat(f.fileno())
+        print(f'Reading file {file} from {offset}')
+        parsed_to = offset
+        if st.st_size > offset:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                if not encoding:
+                    detected = detect_encoding(buf)
+                # Nothing to tell by yet means plain ascii, the same in both
+                engine = engines[encoding or detected or SPOOL_ENCODINGS[0]]
+                spans = find_report_spans(engine, buf, offset, include_markers)
+                if not all(span[3] for span in spans) and time.time() - st.st_mtime < open_wait_sec:
+                    unfinished = True
+                    spans = []
+                for pos, report_lines in extract_reports(engine, buf, spans):
+                    put_report(report_lines)
+                    found += 1
+                # Only whole lines count as parsed, a half written last line is read again.
+                parsed_to = buf.rfind(b'\n', offset) + 1 or offset
+        prefix_hash = get_prefix_hash(f, parsed_to)
+    return {'ino': st.st_ino, 'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'hash': prefix_hash,
+            'offset': parsed_to, 'found': found, 'unfinished': unfinished, 'encoding': detected}
+
+
+def collect_spool_file(file: str, offset: int, engines: dict, encoding: str, include_markers: bool,
+                       open_wait_sec: float) -> dict:
+    """scan_spool_file() for a catch-up process, the reports come back in result['reports']."""
+    reports = []
+    result = scan_spool_file(file, offset, engines, encoding, include_markers, open_wait_sec, reports.append)
+    result['reports'] = reports
+    return result
+
+
+def commit_spool_file(file: str, spool_dir: dict, scan) -> bool:
+    """Runs scan(put_report) in one outbox transaction, archives the file only after that is committed.
+
+    True if reports were queued, False if the file has none, None while a report in it is unfinished.
+    """
+    global spool_index_dirty
+    tmp_name = f'rep{random.randint(0, 9999999)}'
+    letters = itertools.count()
+
+    def put_report(report_lines: list):
+        save_report_to_outbox(tmp_name + '-' + get_letter(next(letters)), report_lines)
+
+    db = get_outbox_db()
+    db.execute('BEGIN IMMEDIATE')
+    try:
+        result = scan(put_report)
+    except Exception:
+        db.execute('ROLLBACK')
+        raise
+    db.execute('COMMIT')
+    remember_dir_encoding(spool_dir, result['encoding'])
+    if result['unfinished']:   # Not indexed either, so it is read again from the start
+        print(f'A report in {file} has no end marker yet, waiting for the driver.')
+        return None
+    if not result['found']:
+        print(f'No reports in {file}')
+        with spool_index_lock:
+            spool_index[file] = {key: result[key] for key in ('ino', 'size', 'mtime_ns', 'hash', 'offset')}
+            spool_index_dirty = True
+        return False
+    outbox_wakeup.set()   # outbox_put() set it before the commit, the sender may have looked too early
+
+    logger.info(f'Report(s) found in {file}, will copy it to {tmp_name} and delete.')
+    copy_and_delete_original(tmp_name, file)
+    with spool_index_lock:
+        spool_index.pop(file, None)
+        spool_index_dirty = True
+    return True
+
+
+def read_spool_file(file: str, offset: int, spool_dir: dict) -> bool:
+    """Reads file in this thread, reports go to the outbox as they are found."""
+    return commit_spool_file(file, spool_dir, lambda put_report: scan_spool_file(
+        file, offset, spool_dir['engines'], get_dir_encoding(spool_dir), config['include_markers'] == True,
+        config.get("open_report_wait_sec", OPEN_REPORT_WAIT_SEC), put_report))
+
+
+def put_collected(result: dict, put_report) -> dict:
+    for report_lines in result.pop('reports'):
+        put_report(report_lines)
+    return result
+
+
+def process_spool_file(file: str, spool_dir: dict) -> bool:
+    offset = get_file_offset(file)
+    if offset is None:
+        return False
+    return read_spool_file(file, offset, spool_dir)
+
+
+def get_mtime(file: str) -> int:
+    try:
+        return os.stat(file).st_mtime_ns
+    except OSError:
+        return 0   # Gone already, processing it will notice
+
+
+def catch_up(todo: list, spool_dir: dict):
+    """Backlog after downtime: files are read in parallel processes, committed one by one in mtime order.
+
+    todo is [(file, offset), ...]. Only a few files per process are read ahead, so the reports
+    waiting for their turn do not pile up in memory.
+    """
+    todo = sorted(todo, key=lambda item: get_mtime(item[0]))
+    workers = min(len(todo), config.get("catchup_workers") or os.cpu_count() or 2)
+    logger.info(f'Catching up on {len(todo)} spool files in {spool_dir["path"]} with {workers} processes.')
+    started = time.time()
+    encoding = get_dir_encoding(spool_dir)
+    include_markers = config['include_markers'] == True
+    open_wait_sec = config.get("open_report_wait_sec", OPEN_REPORT_WAIT_SEC)
+    # Not fork: this process has live threads (watcher, senders, other folders), a child could inherit
+    # a lock one of them holds and hang. spawn is also what the Windows exe gets.
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+        tasks = []
+        next_task = 0
+        while tasks or next_task < len(todo):
+            while next_task < len(todo) and len(tasks) < workers * 2:
+                file, offset = todo[next_task]
+                tasks.append((file, offset, pool.submit(collect_spool_file, file, offset, spool_dir['engines'],
+                                                        encoding, include_markers, open_wait_sec)))
+                next_task += 1
+            file, offset, future = tasks.pop(0)   # In submit order, so reports reach the outbox chronologically
+            try:
+                try:
+                    result = future.result()
+                except Exception as e:
+                    logger.error(f'catch_up() worker failed on {file}, reading it here: {e}')
+                    read_spool_file(file, offset, spool_dir)
+                    continue
+                commit_spool_file(file, spool_dir, lambda put_report: put_collected(result, put_report))
+            except Exception as e:
+                logger.error(f'catch_up() error on {file}: {e} {traceback.format_exc()}')
+    logger.info(f'Caught up on {len(todo)} spool files in {time.time() - started:.1f} sec.')
+
+
+def process_spool_files(files: list, spool_dir: dict):
+    """Reads the files that changed, through catch_up() when there are catchup_min_files of them."""
+    todo = []
+    for file in files:
         try:
-            files = []
-            printer_dir = config["printer_dir"]
-            for file in os.listdir(printer_dir):
-                fpath = os.path.join(printer_dir, file)
-                if not os.path.isdir(fpath) and file != ".DS_Store":
-                    files.append(fpath)
+            offset = get_file_offset(file)
+        except Exception as e:
+            logger.error(f'process_spool_files() error on {file}: {e} {traceback.format_exc()}')
+            continue
+        if offset is not None:
+            todo.append((file, offset))
+    if len(todo) >= config.get("catchup_min_files", CATCHUP_MIN_FILES):
+        catch_up(todo, spool_dir)
+        return
+    for file, offset in todo:
+        try:
+            read_spool_file(file, offset, spool_dir)
+        except Exception as e:
+            logger.error(f'process_spool_files() error on {file}: {e} {traceback.format_exc()}')
 
+
+def check_for_reports_loop(spool_dir: dict):
+    while True:
+        print(f'check_for_reports_loop() invoked for {spool_dir["path"]}')
+        try:
+            files = list_spool_files(spool_dir["path"])
             print(f'Files to check:{files}')
 
-            for file in files:
-                report_found = False
-                lines = None
-                tmp_name = f'rep{random.randint(0, 9999999)}'
-                print(f'Reading file {file}')
-                with open(file, 'r') as f:
-                    lines = f.readlines()
-                    #lines = data.split('\n')
-                i = 0
-                for marker in config['markers']:
-                    print('------------------------')
-                    print(f'Current marker {marker}')
-                    report_lines = get_report_by_markers(marker, lines)
-                    if len(report_lines) > 0:
-                        report_found = True
-                        tmp_name_rep = tmp_name + '-' + get_letter(i)
-                        save_report_tosend_folder(tmp_name_rep, report_lines)
-                    else:
-                        print('Report not found')
-                    i += 1
-                if report_found:
-                    logger.info(f'Report(s) found in {file}, will copy it to {tmp_name} and delete.')
-                    copy_and_delete_original(tmp_name, file)
+            prune_spool_index(spool_dir["path"], files)
+            process_spool_files(files, spool_dir)
+            save_spool_index()
 
         except Exception as e:
             logger.error(f'check_for_reports_loop() error: {e} {traceback.format_exc()}')
@@ -196,6 +787,141 @@ def check_for_reports_loop():
         print(f'check_for_reports_loop sleep {config["sleep_parse_sec"]} sec.')
         time.sleep(config["sleep_parse_sec"])
 
+
+class SpoolEventHandler(FileSystemEventHandler):
+    """Collects changed spool paths, check_for_reports_watch() debounces them."""
+
+    def __init__(self, printer_dir: str, pending: dict, lock: threading.Lock, wakeup: threading.Event):
+        self.printer_dir = os.path.abspath(printer_dir)
+        self.pending = pending
+        self.lock = lock
+        self.wakeup = wakeup
+
+    def touch(self, path: str):
+        if os.path.basename(path) == ".DS_Store":
+            return
+        if os.path.dirname(os.path.abspath(path)) != self.printer_dir:
+            return  # Moved out of the spool folder, e.g. by us into deleted/
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            size = None
+        with self.lock:
+            self.pending[path] = (time.monotonic(), size)
+        self.wakeup.set()
+
+    def on_created(self, event):
+        if not event.is_directory:
+            self.touch(event.src_path)
+
+    def on_modified(self, event):
+        if not event.is_directory:
+            self.touch(event.src_path)
+
+    def on_closed(self, event):
+        # IN_CLOSE_WRITE on linux, the driver is done with the file.
+        if not event.is_directory:
+            self.touch(event.src_path)
+
+    def on_moved(self, event):
+        if not event.is_directory:
+            self.touch(event.dest_path)
+
+
+def get_size(file: str) -> int:
+    try:
+        return os.path.getsize(file)
+    except OSError:
+        return None   # Gone or locked, the pending entry finds out when it is due
+
+
+def check_for_reports_watch(spool_dir: dict):
+    printer_dir = spool_dir["path"]
+    debounce_sec = config.get("watch_debounce_sec", 0.5)
+    pending = {}
+    lock = threading.Lock()
+    wakeup = threading.Event()
+
+    observer = Observer()
+    observer.schedule(SpoolEventHandler(printer_dir, pending, lock, wakeup), printer_dir, recursive=False)
+    observer.start()
+    logger.info(f'Watching {printer_dir} for new spool files, debounce {debounce_sec} sec.')
+    try:
+        watch_pending(spool_dir, pending, lock, wakeup, debounce_sec)
+    except Exception:
+        observer.stop()   # The caller falls back to polling, events must not pile up meanwhile
+        observer.join()
+        raise
+
+
+def watch_pending(spool_dir: dict, pending: dict, lock: threading.Lock, wakeup: threading.Event, debounce_sec: float):
+    global spool_index_dirty
+    printer_dir = spool_dir["path"]
+    # Files printed while the client was down do not produce events.
+    files = list_spool_files(printer_dir)
+    prune_spool_index(printer_dir, files)
+    if len(files) >= config.get("catchup_min_files", CATCHUP_MIN_FILES):
+        process_spool_files(files, spool_dir)
+        save_spool_index()
+        files = list_spool_files(printer_dir)   # Left over ones failed or are unfinished, they are tried again below
+    now = time.monotonic()
+    with lock:
+        for file in files:
+            pending[file] = (now - debounce_sec, get_size(file))
+
+    while True:
+        due = []
+        with lock:
+            now = time.monotonic()
+            for file, (touched, size) in list(pending.items()):
+                if now - touched >= debounce_sec:
+                    due.append((file, size))
+                    del pending[file]
+            wait_sec = min([debounce_sec - (now - t) for t, _ in pending.values()], default=None)
+
+        for file, size in due:
+            try:
+                if not os.path.isfile(file):
+                    with spool_index_lock:
+                        if spool_index.pop(file, None) is not None:
+                            spool_index_dirty = True
+                    continue
+                cur_size = os.path.getsize(file)
+                if cur_size != size:
+                    # Size still moving, the driver has not finished writing.
+                    with lock:
+                        pending.setdefault(file, (time.monotonic(), cur_size))
+                    continue
+                if process_spool_file(file, spool_dir) is None:
+                    # A report without its end marker yet, the driver may have paused in the middle of the job
+                    with lock:
+                        pending.setdefault(file, (time.monotonic() + WATCH_RETRY_SEC - debounce_sec, cur_size))
+            except Exception as e:
+                logger.error(f'check_for_reports_watch() error on {file}, will retry in {WATCH_RETRY_SEC} sec.: '
+                             f'{e} {traceback.format_exc()}')
+                # e.g. PermissionError on Windows while the driver still holds the file, no new event may come
+                with lock:
+                    pending.setdefault(file, (time.monotonic() + WATCH_RETRY_SEC - debounce_sec, get_size(file)))
+
+        if due:
+            save_spool_index()
+            continue
+        wakeup.wait(wait_sec)
+        wakeup.clear()
+
+
+def run_reports_checker(spool_dir: dict):
+    """Worker of one printer folder, all of them put reports into the same outbox."""
+    if config.get("watch_mode", True) and Observer is not None:
+        try:
+            check_for_reports_watch(spool_dir)
+            return
+        except Exception as e:
+            logger.error(f'run_reports_checker() watcher failed, falling back to polling: {e} {traceback.format_exc()}')
+    elif config.get("watch_mode", True):
+        logger.warning(f'watchdog is not installed, falling back to polling {spool_dir["path"]}.')
+    check_for_reports_loop(spool_dir)
+
 def encode_key(str):
     string_bytes = str.encode("ascii")
     base64_bytes = base64.b64encode(string_bytes)
@@ -203,22 +929,112 @@ def encode_key(str):
     return base64_string
 
 
-def send_file_to_server(addr: str, fpath: str):
-    logger.info('###############################')
-    data_plain_text = None
-    with open(fpath, 'r') as f:
-        data = f.read()
+http_session = requests.Session()
+http_session.mount('http://', requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=16))
+http_session.mount('https://', requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=16))
+batch_supported = {}   # server addr -> False when it has no /send_reps
+server_caps = {}       # server addr -> what its /caps answered
 
-    nl_pos = data.find('\n')
-    rep_title = data[0:nl_pos]
-    rep_data = data[data.find('\n'):]
+
+def get_server_caps(addr: str) -> dict:
+    caps = server_caps.get(addr)
+    if caps is None:
+        resp = http_session.get(addr + '/caps', timeout=SEND_TIMEOUT)
+        try:
+            caps = resp.json() if resp.ok else {}
+        except ValueError:
+            caps = {}
+        logger.info(f'Server {addr} capabilities: {caps}')
+        server_caps[addr] = caps
+    return caps
+
+
+def post_json(addr: str, path: str, json_data: dict) -> tuple:
+    """Posts json_data, gzipped when the server advertises it. Returns (resp, resp_body)."""
+    body = json.dumps(json_data, ensure_ascii=False).encode('utf-8')   # \uXXXX would make Cyrillic 6 bytes a letter
+    headers = {'Content-Type': 'application/json'}
+    if len(body) >= COMPRESS_MIN_BYTES and 'gzip' in get_server_caps(addr).get('content_encodings', []):
+        body = gzip.compress(body, 6)
+        headers['Content-Encoding'] = 'gzip'
+    resp = http_session.post(addr + path, data=body, headers=headers, timeout=SEND_TIMEOUT, stream=True)
+    if resp.status_code == 503:   # Busy or restarting, everything due backs off
+        resp.close()
+        raise Exception(f'{addr} is busy, retry after {resp.headers.get("Retry-After", "?")} sec.')
+    resp_body = b''
+    for chunk in resp.iter_content(64 * 1024):
+        resp_body += chunk
+        if len(resp_body) > MAX_RESPONSE_BYTES:
+            resp.close()
+            raise Exception(f'Response from {addr}{path} is larger than {MAX_RESPONSE_BYTES} bytes.')
+    return resp, resp_body
+
+
+def report_digest(rest_id, rep_title: str, rep_text: str) -> str:
+    """Stable id of a report, the server skips a digest it has already taken."""
+    return hashlib.sha256(f'{rest_id}\0{rep_title}\0{rep_text}'.encode('utf-8')).hexdigest()
+
+
+def set_base(rep_title: str, rep_text: str):
+    """The server has taken this report, the next one with the title can go as a diff against it."""
+    get_outbox_db().execute('INSERT OR REPLACE INTO bases (rep_title, digest, rep_text) VALUES (?, ?, ?)',
+                            (rep_title, report_digest(config["restaurant_id"], rep_title, rep_text), rep_text))
+
+
+def drop_base(rep_title: str):
+    get_outbox_db().execute('DELETE FROM bases WHERE rep_title = ?', (rep_title,))
+
+
+def delta_for(rep_title: str, rep_text: str, base: tuple = None):
+    """(base digest, line diff) against the last acknowledged report of the title, None if the diff is not worth it.
+
+    base (digest, text) is given for a report that goes right after one with the same title in a batch.
+    The diff is [["=", first, end], ["+", text], ...]: copy base lines [first:end), add text.
+    """
+    if len(rep_text) < DELTA_MIN_BYTES:
+        return None
+    if base is None:
+        base = get_outbox_db().execute('SELECT digest, rep_text FROM bases WHERE rep_title = ?',
+                                       (rep_title,)).fetchone()
+    if base is None:
+        return None
+    base_lines = base[1].splitlines(keepends=True)
+    lines = rep_text.splitlines(keepends=True)
+    delta = []
+    matcher = difflib.SequenceMatcher(None, base_lines, lines, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            delta.append(['=', i1, i2])
+        elif tag in ('replace', 'insert'):
+            delta.append(['+', ''.join(lines[j1:j2])])
+    if len(json.dumps(delta, ensure_ascii=False)) > len(rep_text) * DELTA_MAX_SHARE:
+        return None
+    return base[0], delta
+
+
+def report_json(addr: str, rep_title: str, rep_text: str, use_delta: bool, base: tuple = None) -> dict:
+    """Report fields of a post, a diff instead of the text when the server takes diffs."""
     json_data = {
-        "rest_id": config["restaurant_id"],
         "rep_title": rep_title,
-        "rep_text": rep_data
+        "digest": report_digest(config["restaurant_id"], rep_title, rep_text)
     }
-    resp = requests.post(addr + '/send_rep', json = json_data)
-    resp_text = resp.text.strip()
+    delta = delta_for(rep_title, rep_text, base) if use_delta and get_server_caps(addr).get('delta') else None
+    if delta:
+        json_data["base_digest"], json_data["delta"] = delta
+    else:
+        json_data["rep_text"] = rep_text
+    return json_data
+
+
+def send_report_to_server(addr: str, rep_title: str, rep_text: str, use_delta: bool = True):
+    logger.info('###############################')
+    json_data = {"rest_id": config["restaurant_id"]}
+    json_data.update(report_json(addr, rep_title, rep_text, use_delta))
+    resp, resp_body = post_json(addr, '/send_rep', json_data)
+    if resp.status_code == 409 and use_delta:   # Server has another base, send the whole text
+        logger.info(f'Server asks for the full text of {rep_title}.')
+        drop_base(rep_title)
+        return send_report_to_server(addr, rep_title, rep_text, False)
+    resp_text = resp_body.decode('utf-8', errors='replace').strip()
     logger.info(f'Resp:{resp_text}')
     if resp.ok:
         logger.info('OK received :)')
@@ -228,42 +1044,275 @@ def send_file_to_server(addr: str, fpath: str):
     return False
 
 
+def iter_chunks(text: str, max_bytes: int):
+    """Pieces of text of at most max_bytes in utf-8, cut after line ends. Joined they give text back."""
+    chunk = []
+    size = 0
+    for line in text.splitlines(keepends=True):
+        line_size = len(line.encode('utf-8'))
+        if chunk and size + line_size > max_bytes:
+            yield ''.join(chunk)
+            chunk = []
+            size = 0
+        while line_size > max_bytes:   # One line longer than a chunk, cut between characters
+            piece = line.encode('utf-8')[:max_bytes].decode('utf-8', errors='ignore')
+            yield piece
+            line = line[len(piece):]
+            line_size = len(line.encode('utf-8'))
+        chunk.append(line)
+        size += line_size
+    if chunk:
+        yield ''.join(chunk)
+
+
+def send_report_chunked(addr: str, rep_title: str, rep_text: str, chunk_bytes: int) -> bool:
+    """Sends the report in numbered chunks, the server says which chunk it expects next."""
+    chunks = list(iter_chunks(rep_text, chunk_bytes))
+    report_id = report_digest(config["restaurant_id"], rep_title, rep_text)
+    logger.info(f'Sending {rep_title} in {len(chunks)} chunks as {report_id}.')
+    seq = 0
+    for i in range(len(chunks) * 2):   # Room for resending after the server lost a partial report
+        json_data = {
+            "rest_id": config["restaurant_id"],
+            "report_id": report_id,
+            "rep_title": rep_title,
+            "seq": seq,
+            "total": len(chunks),
+            "data": chunks[seq]
+        }
+        resp, resp_body = post_json(addr, '/send_chunk', json_data)
+        if resp.status_code not in (200, 409):   # 409: not the chunk the server expects
+            logger.info(f'Bad response:{resp_body.decode("utf-8", errors="replace").strip()}')
+            return False
+        answer = json.loads(resp_body)
+        if answer['done']:
+            return True
+        seq = answer['next_seq']
+    return False
+
+
+def split_batch(addr: str, reports: list) -> list:
+    """Cuts the reports into posts within the batch limits the server advertises, order kept."""
+    caps = get_server_caps(addr)
+    max_count = caps.get('max_batch_reports', BATCH_MAX_REPORTS)
+    max_bytes = caps.get('max_body_bytes', 0) - BATCH_ENVELOPE_BYTES
+    parts = []
+    part = []
+    size = 0
+    for rep in reports:
+        rep_size = len(json.dumps(rep, ensure_ascii=False).encode('utf-8')) + 1
+        if part and (len(part) >= max_count or (max_bytes > 0 and size + rep_size > max_bytes)):
+            parts.append(part)
+            part = []
+            size = 0
+        part.append(rep)
+        size += rep_size
+    if part:
+        parts.append(part)
+    return parts
+
+
+def send_batch_to_server(addr: str, batch: list, use_delta: bool = True):
+    """Posts many reports at once, returns {rep_id: ok} or None if the server has no batch endpoint.
+
+    ok is NEED_FULL for a diff the server could not apply. The reports go in as many posts as the
+    server limits need, a post refused with 413 is halved. Reports without an answer are not acknowledged.
+    """
+    logger.info(f'Sending batch of {len(batch)} reports.')
+    reports = []
+    bases = {}   # The server takes the reports in order, each one is the base of the next with its title
+    for rep_id, name, rep_title, rep_text, attempts, grp in batch:
+        rep = {"id": rep_id, "grp": grp}
+        rep.update(report_json(addr, rep_title, rep_text, use_delta, bases.get(rep_title)))
+        bases[rep_title] = (rep["digest"], rep_text)
+        reports.append(rep)
+    groups = {rep["id"]: rep["grp"] for rep in reports}
+
+    acks = {}
+    failed_groups = set()   # Later parts of these spool files wait, as the server does within one post
+    parts = split_batch(addr, reports)
+    while parts:
+        part = [rep for rep in parts.pop(0) if rep["grp"] not in failed_groups]
+        if not part:
+            continue
+        json_data = {
+            "rest_id": config["restaurant_id"],
+            "reports": part
+        }
+        resp, resp_body = post_json(addr, '/send_reps', json_data)
+        if resp.status_code == 404:
+            return None
+        if resp.status_code == 413 and len(part) > 1:
+            logger.info(f'Batch of {len(part)} reports is too large for {addr}, splitting it.')
+            parts[:0] = [part[:len(part) // 2], part[len(part) // 2:]]
+            continue
+        if not resp.ok:
+            logger.info(f'Bad response:{resp_body.decode("utf-8", errors="replace").strip()}')
+            break   # The rest is not sent, so no part of a spool file overtakes another
+        for result in json.loads(resp_body)['results']:
+            acks[result['id']] = NEED_FULL if result.get('need_full') else result['ok'] == True
+            if acks[result['id']] != True:
+                failed_groups.add(groups.get(result['id']))
+    return acks
+
+
+def ack_report(row: tuple, is_sent_ok: bool):
+    rep_id, name, rep_title, rep_text, attempts, grp = row
+    if is_sent_ok:
+        outbox_done(rep_id)
+        set_base(rep_title, rep_text)
+    else:
+        outbox_retry(rep_id, attempts, 'Not acknowledged')
+
+
+def group_due_reports(due: list, batch_size: int) -> list:
+    """Packs whole spool-file groups into units of about batch_size reports, one unit per worker."""
+    groups = {}
+    for row in due:
+        groups.setdefault(row[5], []).append(row)
+    units = []
+    unit = []
+    for rows in groups.values():
+        if unit and len(unit) + len(rows) > batch_size:
+            units.append(unit)
+            unit = []
+        unit.extend(rows)
+    if unit:
+        units.append(unit)
+    return units
+
+
+def send_batch(addr: str, batch: list, failed_groups: set):
+    """Sends the rows with one batch post or one by one, a report that fails holds back the rest of its spool file.
+
+    Reports whose diff the server could not apply go once more with the full text, with the rest of their group.
+    """
+    batch = [row for row in batch if row[5] not in failed_groups]
+    use_delta = True
+    while batch:
+        acks = None
+        if batch_supported.get(addr, True):
+            acks = send_batch_to_server(addr, batch, use_delta)
+            if acks is None:
+                logger.info(f'{addr} has no batch endpoint, will send reports one by one.')
+                batch_supported[addr] = False
+
+        resend = []
+        resend_groups = set()
+        for row in batch:
+            if row[5] in failed_groups:
+                continue
+            if row[5] in resend_groups:
+                resend.append(row)   # Failed on the server after the part that needs the full text
+                continue
+            if acks is None:
+                logger.info(f'Trying to send {row[1]} ({row[0]}) to {addr}')
+                is_sent_ok = send_report_to_server(addr, row[2], row[3])
+            else:
+                is_sent_ok = acks.get(row[0], False)
+            if is_sent_ok == NEED_FULL and use_delta:
+                logger.info(f'Server asks for the full text of {row[2]}.')
+                drop_base(row[2])
+                resend.append(row)
+                resend_groups.add(row[5])
+                continue
+            ack_report(row, is_sent_ok == True)
+            if is_sent_ok != True:
+                failed_groups.add(row[5])
+        batch = resend
+        use_delta = False
+
+
+def send_unit(addr: str, unit: list, batch_size: int):
+    """Sends a unit in order, reports larger than a chunk go in chunks if the server takes them."""
+    failed_groups = set()
+    caps = get_server_caps(addr)
+    max_chunk = caps.get('max_chunk_bytes', 0)
+    max_report = caps.get('max_report_bytes', 0)
+    batch_size = min(batch_size, caps.get('max_batch_reports', BATCH_MAX_REPORTS))
+    chunk_bytes = min(config.get("chunk_bytes", CHUNK_BYTES), max_chunk)
+    batch = []
+    for row in unit:
+        size = len(row[3].encode('utf-8'))
+        if max_report and size > max_report:   # Would be refused with 413 on every retry
+            outbox_park(row, f'{size} bytes, the server takes at most {max_report}')
+            continue
+        if max_chunk and size > chunk_bytes:
+            send_batch(addr, batch, failed_groups)
+            batch = []
+            if row[5] in failed_groups:
+                continue
+            is_sent_ok = send_report_chunked(addr, row[2], row[3], chunk_bytes)
+            ack_report(row, is_sent_ok)
+            if not is_sent_ok:
+                failed_groups.add(row[5])
+            continue
+        batch.append(row)
+        if len(batch) >= batch_size:
+            send_batch(addr, batch, failed_groups)
+            batch = []
+    send_batch(addr, batch, failed_groups)
+
+
+send_pool = None
+
+
+def send_due_reports(addr: str, due: list):
+    global send_pool
+    if send_pool is None:
+        send_pool = ThreadPoolExecutor(max_workers=config.get("send_workers", SEND_WORKERS),
+                                       thread_name_prefix='sender')
+    batch_size = config.get("send_batch_size", SEND_BATCH_SIZE)
+    futures = [send_pool.submit(send_unit, addr, unit, batch_size)
+               for unit in group_due_reports(due, batch_size)]
+    errors = [future.exception() for future in futures if future.exception()]
+    if errors:
+        raise errors[0]
+
+
 def send_reports_loop():
-    tosend_dir = 'tosend'
     while True:
         print('send_reports_loop() invoked')
         try:
             cleanup_logs_if_need()
 
-            addr_to_send = get_bot_server_addr()
-            for file in sorted(os.listdir(tosend_dir)):
-                fpath = os.path.join(tosend_dir, file)
-                if not os.path.isdir(fpath) and file != ".DS_Store":
-                    logger.info(f'Trying to send {fpath} to {addr_to_send}')
-                    try:
-                        is_sent_ok = send_file_to_server(addr_to_send, fpath)
-                        if is_sent_ok:
-                            os.remove(fpath)
-                    except Exception as e:
-                        logger.error(f'send_reports_loop(), send_file_to_server() level: {e} {traceback.format_exc()}')
+            due = outbox_due(OUTBOX_SEND_BATCH)
+            if due:
+                addr_to_send = get_bot_server_addr()
+                try:
+                    send_due_reports(addr_to_send, due)
+                except Exception as e:
+                    logger.error(f'send_reports_loop(), send_due_reports() level: {e} {traceback.format_exc()}')
+                    outbox_fail_due(str(e))
+                    invalidate_bot_server_addr()
 
         except Exception as e:
             logger.error(f'send_reports_loop() error: {e} {traceback.format_exc()}')
 
-        print(f'send_reports_loop sleep {config["sleep_send_sec"]} sec.')
-        time.sleep(config["sleep_send_sec"])
+        wait_sec = outbox_next_wait(config["sleep_send_sec"])
+        print(f'send_reports_loop sleep {wait_sec:.1f} sec.')
+        outbox_wakeup.wait(wait_sec)
+        outbox_wakeup.clear()
 
 
 if __name__ == '__main__':
+    multiprocessing.freeze_support()   # Catch-up processes of the pyinstaller exe
     logger.info('--------------------')
     cleanup_logs_if_need()
     logger.info('Report Client v2 init...')
     check_dirs_files()
     global config
     config = read_config()
-    get_bot_server_addr(log_everything=True)
-    thread = threading.Thread(target=check_for_reports_loop)
+    spool_dirs = get_spool_dirs()
+    load_spool_index()
+    open_outbox()
+    refresh_bot_server_addr(log_everything=True)
+    scan_threads = [threading.Thread(target=run_reports_checker, args=(spool_dir,), name=f'scan-{i}')
+                    for i, spool_dir in enumerate(spool_dirs)]
     thread2 = threading.Thread(target=send_reports_loop)
-    logger.info('Report Client v2 started :)')
-    thread.start()
-    thread2.start()
\ No newline at end of file
+    thread3 = threading.Thread(target=addr_refresh_loop, daemon=True)
+    logger.info(f'Report Client v2 started for {len(spool_dirs)} printer folder(s) :)')
+    for thread in scan_threads:
+        thread.start()
+    thread2.start()
+    thread3.start()
\ No newline at end of file
@@ -95,39 +95,58 @@ def get_bot_server_ip(log_everything: bool = False) -> str:
         return def_ip_addr
 
 
-def get_report_by_markers(marker: list, lines: list) -> list:
-    rep_lines = []
-    print(lines)
-    mark_name = marker[0]
-    mark_start = marker[1]
-    mark_end = marker[2]
-    if len(mark_end) == 0:
-        mark_end = "$default"
-
-    print(f'Marker start:{mark_start}; Marker end:{mark_end};')
-    rep_found = False
+def build_marker_engine(markers: list) -> dict:
+    """Start/end regexes of all reports folded into one compiled alternation.
+
+    re.match of the alternation is true exactly when some marker would match,
+    the few lines that pass are then checked with each marker regex.
+    """
+    compiled = []
+    patterns = []
+    for marker in markers:
+        mark_end = re.compile(marker[2]) if len(marker[2]) > 0 else None
+        compiled.append((marker[0], re.compile(marker[1]), mark_end))
+        patterns.append(marker[1])
+        if mark_end:
+            patterns.append(marker[2])
+    alternation = re.compile('|'.join([f'(?:{p})' for p in patterns]))
+    logger.info(f'Marker engine built for {len(markers)} markers.')
+    return {'markers': compiled, 'regex': alternation}
+
+
+def extract_reports(engine: dict, lines: list) -> list:
+    """Single pass over the lines, returns [(marker_pos, rep_lines), ...] in file order."""
+    markers = engine['markers']
+    regex = engine['regex']
+    include_markers = config['include_markers'] == True
+    open_reps = {}   # marker pos -> lines of the report being read
+    found = []
     for line in lines:
         line = line.replace('\n', '')
-        if not rep_found:   # Если не наткнулись на начало отчета
-            if re.match(mark_start, line):
-                rep_lines.append(f'[отчет: {mark_name}]')
-                if config['include_markers'] == True:
+        if not regex.match(line):
+            for rep_lines in open_reps.values():
+                rep_lines.append(line)
+            continue
+
+        for pos, (mark_name, mark_start, mark_end) in enumerate(markers):
+            rep_lines = open_reps.get(pos)
+            if rep_lines is None:   # Если не наткнулись на начало отчета
+                if mark_start.match(line):
+                    print(f'Found START match of {mark_name} in line:{line}')
+                    rep_lines = [f'[отчет: {mark_name}]']
+                    if include_markers:
+                        rep_lines.append(line)
+                    open_reps[pos] = rep_lines
+                    found.append((pos, rep_lines))
+            elif mark_end and mark_end.match(line):   # Конец отчета
+                print(f'Found END match of {mark_name} in line:{line}')
+                if include_markers:
                     rep_lines.append(line)
-                print(f'Found START match in line:{line}')
-                rep_found = True
+                del open_reps[pos]
             else:
-                print(f'do not match:"{line}"')
-        else:   # Если уже читаем отчет
-            if mark_end != '$default' and re.match(mark_end, line):
-                print(f'Found END match in line:{line}')
-                if config['include_markers'] == True:
-                    rep_lines.append(line)
-                break
-
-            rep_lines.append(line)
+                rep_lines.append(line)
 
-    # print(f'Ret report:{rep_lines}')
-    return rep_lines
+    return found
 
 def prepare_rep_to_send(rep_plain_text: str) -> str:
     str_rep = rep_plain_text.strip()
@@ -143,6 +162,27 @@ def copy_and_delete_original(tmp_name, fpath) -> str:
     os.remove(fpath)
 
 
+def split_on_lines(text: str, max_size: int) -> list:
+    """Parts of at most max_size characters, cut between lines. Longer lines are cut as they are."""
+    parts = []
+    part = ''
+    for line in text.split('\n'):
+        while len(line) > max_size:
+            if part:
+                parts.append(part)
+                part = ''
+            parts.append(line[0:max_size])
+            line = line[max_size:]
+        if part and len(part) + 1 + len(line) > max_size:
+            parts.append(part)
+            part = line
+        else:
+            part = f'{part}\n{line}' if part else line
+    if part:
+        parts.append(part)
+    return parts
+
+
 def save_report_tosend_folder(tmp_name, rep_lines: list):
     max_msg_size = 1900
     rep_plain_text = '\n'.join([i for i in rep_lines[0:]])
@@ -153,22 +193,11 @@ def save_report_tosend_folder(tmp_name, rep_lines: list):
             f.write(rep_to_send)
         logger.info(f'Report saved to {path}')
     else:
-        messages = []
-        tmp_message_data = rep_plain_text
         logger.info(f'Message to long, will be divided')
-        for i in range(10):
-            if len(tmp_message_data) > max_msg_size:
-                rep_part = tmp_message_data[0:max_msg_size]
-                rep_part = f'[часть {i+1}]\n{rep_part}'
-                tmp_message_data = tmp_message_data[max_msg_size:]
-                messages.append(rep_part)
-            else:
-                rep_part = tmp_message_data[0:]
-                rep_part = f'[часть {i + 1}]\n{rep_part}'
-                messages.append(rep_part)
-                break
+        messages = [f'[часть {i + 1}]\n{rep_part}'
+                    for i, rep_part in enumerate(split_on_lines(rep_plain_text, max_msg_size))]
         for i in range(len(messages)):
-            path = os.path.join('tosend', f'{tmp_name}-{i}.txt')
+            path = os.path.join('tosend', f'{tmp_name}-{i:03d}.txt')   # Sent in name order
             rep_to_send = prepare_rep_to_send(messages[i])
             with open(path, 'w') as f:
                 f.write(rep_to_send)
@@ -202,18 +231,13 @@ def check_for_reports_loop():
                 with open(file, 'r') as f:
                     lines = f.readlines()
                     #lines = data.split('\n')
-                i = 0
-                for marker in config['markers']:
-                    print('------------------------')
-                    print(f'Current marker {marker}')
-                    report_lines = get_report_by_markers(marker, lines)
-                    if len(report_lines) > 0:
-                        report_found = True
-                        tmp_name_rep = tmp_name + '-' + get_letter(i)
-                        save_report_tosend_folder(tmp_name_rep, report_lines)
-                    else:
-                        print('Report not found')
-                    i += 1
+                reports = extract_reports(marker_engine, lines)
+                for i, (pos, report_lines) in enumerate(reports):
+                    report_found = True
+                    tmp_name_rep = tmp_name + '-' + get_letter(i)
+                    save_report_tosend_folder(tmp_name_rep, report_lines)
+                if not report_found:
+                    print(f'No reports in {file}')
                 if report_found:
                     logger.info(f'Report(s) found in {file}, will copy it to {tmp_name} and delete.')
                     copy_and_delete_original(tmp_name, file)
@@ -283,6 +307,7 @@ if __name__ == '__main__':
     check_dirs_files()
     global config
     config = read_config()
+    marker_engine = build_marker_engine(config['markers'])
     get_bot_server_ip(log_everything=True)
     thread = threading.Thread(target=check_for_reports_loop)
     thread2 = threading.Thread(target=send_reports_loop)
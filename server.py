@@ -1,28 +1,105 @@
+import gzip
+import hashlib
+import heapq
+import io
+import itertools
 import json
 import os
+import re
+import secrets
+import shutil
+import signal
 import logging
+import sqlite3
 import sys
 import threading
+import time
 import traceback
+import zlib
 import telebot
+import shift_stats
+from concurrent.futures import Future
 from datetime import datetime
 
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, abort, g
+from werkzeug.serving import make_server
 
-db = None
+try:
+    from waitress import create_server   # Production WSGI server, optional
+except ImportError:
+    create_server = None
+
+db = None          # "u<chat_id>" -> {'name', 'rests'}, read cache of the users/subs tables
+subs_index = {}   # rest_id -> set of subscribed chat ids
+db_lock = threading.Lock()
+store_local = threading.local()
+delivery_lock = threading.Lock()
+delivery_wakeup = threading.Event()
+send_cond = threading.Condition()
+send_heap = []   # (priority, seq, chat_id, fn, args, kwargs, future)
+send_seq = itertools.count()
+chat_buckets = {}
+bot_senders = []
+http_server = None
+http_inflight = 0
+http_max_inflight = 0   # Set from the threads when serving with waitress, else HTTP_MAX_INFLIGHT
+http_inflight_cond = threading.Condition()
+deliveries_active = 0
+dedup_inserts = itertools.count(1)
+incoming_lock = threading.Lock()
+stats_wakeup = threading.Event()
+shutting_down = threading.Event()
 
 app = Flask(__name__)
 
 HOST = "127.0.0.1"
 PORT = 44516
 BYTES_PER_REP = 48 * 1000
+MAX_REPS_PER_BATCH = 100
+MAX_DECOMPRESSED_BYTES = BYTES_PER_REP * MAX_REPS_PER_BATCH
 REST_ID_LEN = 8
 REP_TITLE_LEN = 25
 LOGS_FILE = "logs_server.txt"
 CONFIG_FILE = "server.json"
-DB_FILE = "users.json"
+CONFIG_WATCH_SEC = 5
+DB_FILE = "users.json"   # Before server.db, migrated once on start
+STORE_FILE = "server.db"
 
 LOGS_MAX_SIZE_MB = 20
+DELIVERY_WORKERS = 4
+DELIVERY_IDLE_SEC = 30
+DELIVERY_RETRY_SEC = 30
+DELIVERY_RETRY_MAX_SEC = 60 * 60
+BOT_SEND_WORKERS = 8
+TG_GLOBAL_PER_SEC = 30   # Bot API limits
+TG_CHAT_PER_SEC = 1
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 1
+HTTP_THREADS = 16
+HTTP_SPARE_THREADS = 2   # waitress threads left to answer 503 and gets while the rest take posts
+HTTP_CONNECTION_LIMIT = 64   # More connections wait in the listen backlog of the OS
+HTTP_MAX_INFLIGHT = 64   # werkzeug has a thread per request, more concurrent posts get 503 there
+HTTP_RETRY_AFTER_SEC = 5
+SHUTDOWN_DRAIN_SEC = 30
+HTTP_FLUSH_SEC = 1
+BOT_UPDATE_THREADS = 4
+WEBHOOK_PATH = '/tg_webhook/'
+DEDUP_TTL_SEC = 14 * 24 * 60 * 60
+DEDUP_MAX_ROWS = 200000
+DEDUP_PRUNE_EVERY = 1000   # New reports between prunes of the dedup table
+ARCHIVE_DIR = "archive"   # archive/<rest_id>/<day>/ while the day lasts, then archive/<rest_id>/<day>.gz
+LEGACY_REPORTS_DIR = "reports"   # Flat report files from before the archive
+ARCHIVE_RETENTION_DAYS = 365
+ARCHIVE_MAINTENANCE_SEC = 60 * 60
+LIST_MAX_ROWS = 50
+INCOMING_DIR = "incoming"   # Reports arriving in chunks, appended as the chunks come
+REPORT_MAX_BYTES = 8 * 1000 * 1000
+INCOMING_STALE_SEC = 2 * 24 * 60 * 60
+STATS_FLUSH_SEC = 5 * 60
+TOTALS_DAYS = 7
+TOTALS_WEEKS = 8
+
+app.config['MAX_CONTENT_LENGTH'] = MAX_DECOMPRESSED_BYTES   # waitress refuses larger bodies before reading them too
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
@@ -39,7 +116,78 @@ file_handler.setFormatter(formatter)
 logger.addHandler(file_handler)
 logger.addHandler(stdout_handler)
 
-def read_db():
+def get_store_db() -> sqlite3.Connection:
+    """Connection of the calling thread, WAL lets the http thread read while the bot writes."""
+    conn = getattr(store_local, 'conn', None)
+    if conn is None:
+        conn = sqlite3.connect(STORE_FILE, timeout=30)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        store_local.conn = conn
+    return conn
+
+def open_store():
+    conn = get_store_db()
+    with conn:
+        conn.execute('''CREATE TABLE IF NOT EXISTS users (
+            chat_id INTEGER PRIMARY KEY,
+            name TEXT)''')
+        conn.execute('''CREATE TABLE IF NOT EXISTS subs (
+            chat_id INTEGER NOT NULL,
+            rest_id TEXT NOT NULL,
+            rest_name TEXT,
+            PRIMARY KEY (chat_id, rest_id))''')
+        conn.execute('''CREATE TABLE IF NOT EXISTS deliveries (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            rest_id TEXT NOT NULL,
+            rep_title TEXT NOT NULL,
+            path TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_try REAL NOT NULL,
+            claimed INTEGER NOT NULL DEFAULT 0,
+            done_chats TEXT NOT NULL DEFAULT '[]',
+            file_id TEXT)''')
+        columns = [row[1] for row in conn.execute('PRAGMA table_info(deliveries)')]
+        if 'file_id' not in columns:   # server.db from before file_id reuse
+            conn.execute('ALTER TABLE deliveries ADD COLUMN file_id TEXT')
+        conn.execute('CREATE INDEX IF NOT EXISTS deliveries_next_try ON deliveries (claimed, next_try)')
+        conn.execute('''CREATE TABLE IF NOT EXISTS dedup (
+            digest TEXT PRIMARY KEY,
+            seen REAL NOT NULL)''')
+        conn.execute('CREATE INDEX IF NOT EXISTS dedup_seen ON dedup (seen)')
+        # path is the report file while its day is open, then the day segment with the gzip member at offset
+        conn.execute('''CREATE TABLE IF NOT EXISTS archive (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            rest_id TEXT NOT NULL,
+            rep_title TEXT NOT NULL,
+            ts REAL NOT NULL,
+            day TEXT NOT NULL,
+            path TEXT NOT NULL,
+            offset INTEGER,
+            length INTEGER)''')
+        conn.execute('CREATE INDEX IF NOT EXISTS archive_rest_ts ON archive (rest_id, ts)')
+        conn.execute('CREATE INDEX IF NOT EXISTS archive_day ON archive (day, offset)')
+        if 'archive_id' not in columns:
+            conn.execute('ALTER TABLE deliveries ADD COLUMN archive_id INTEGER')
+        # Last report per (restaurant, title), clients send the next one as a line diff against it
+        conn.execute('''CREATE TABLE IF NOT EXISTS bases (
+            rest_id TEXT NOT NULL,
+            rep_title TEXT NOT NULL,
+            digest TEXT NOT NULL,
+            text TEXT NOT NULL,
+            PRIMARY KEY (rest_id, rep_title))''')
+        conn.execute('''CREATE TABLE IF NOT EXISTS incoming (
+            report_id TEXT PRIMARY KEY,
+            rest_id TEXT NOT NULL,
+            rep_title TEXT NOT NULL,
+            total INTEGER NOT NULL,
+            next_seq INTEGER NOT NULL DEFAULT 0,
+            bytes INTEGER NOT NULL DEFAULT 0,
+            updated REAL NOT NULL)''')
+    migrate_users_json()
+    prune_dedup()
+
+def read_users_json() -> dict:
     with open(DB_FILE, 'r') as f:
         lines = f.read()
     try:
@@ -48,16 +196,33 @@ def read_db():
         logger.error(
             f'read_config({DB_FILE}) error: {traceback.format_exc()}, can not parse json from data:{lines}')
         raise Exception('Read DB_FILE exception.')
-
-    logger.info(f'read_db() finished. Loaded DB_FILE {ret_dict}')
     return ret_dict
 
-def dump_db():
-    logger.info(f'dump_db() called. arg: {db}')
-    db_str = json.dumps(db)
-    with open(DB_FILE, 'w') as f:
-        f.write(db_str)
-    logger.info(f'dump_db() finished. DB dumped.')
+def migrate_users_json():
+    if not os.path.isfile(DB_FILE):
+        return
+    users = read_users_json()
+    conn = get_store_db()
+    with conn:
+        for user_id, user in users.items():
+            chat_id = int(user_id.replace('u', ''))
+            conn.execute('INSERT OR IGNORE INTO users (chat_id, name) VALUES (?, ?)', (chat_id, user.get('name')))
+            for rest_id, rest_name in get_user_rests(user).items():
+                conn.execute('INSERT OR IGNORE INTO subs (chat_id, rest_id, rest_name) VALUES (?, ?, ?)',
+                             (chat_id, rest_id, rest_name))
+    os.replace(DB_FILE, DB_FILE + '.migrated')
+    logger.info(f'migrate_users_json() moved {len(users)} users from {DB_FILE} to {STORE_FILE}.')
+
+def read_db():
+    ret_dict = {}
+    conn = get_store_db()
+    for chat_id, name in conn.execute('SELECT chat_id, name FROM users'):
+        ret_dict[f'u{chat_id}'] = {'name': name, 'rests': {}}
+    for chat_id, rest_id, rest_name in conn.execute('SELECT chat_id, rest_id, rest_name FROM subs'):
+        ret_dict.setdefault(f'u{chat_id}', {'name': None, 'rests': {}})['rests'][rest_id] = rest_name
+
+    logger.info(f'read_db() finished. Loaded {len(ret_dict)} users from {STORE_FILE}')
+    return ret_dict
 
 def read_config() -> dict:
     logger.info(f'read_config() called')
@@ -77,11 +242,37 @@ def read_config() -> dict:
     return ret_dict
 
 
+def build_rest_registry(conf: dict) -> dict:
+    return {rest['rest_id'].strip(): rest for rest in conf['restaurants']}
+
+def reload_config():
+    """Rereads server.json, readers keep the old snapshot until both globals are swapped."""
+    global config, rest_registry, config_mtime_ns
+    config_mtime_ns = os.stat(CONFIG_FILE).st_mtime_ns   # A broken file is retried only after the next edit
+    try:
+        new_config = read_config()
+        new_registry = build_rest_registry(new_config)
+    except Exception as e:
+        logger.error(f'reload_config() error, keeping the old config: {traceback.format_exc()}')
+        return
+    rest_registry = new_registry
+    config = new_config
+    logger.info(f'reload_config() finished. {len(new_registry)} restaurants.')
+
+def config_watch_loop():
+    while True:
+        config_reload.wait(CONFIG_WATCH_SEC)
+        config_reload.clear()
+        try:
+            if os.stat(CONFIG_FILE).st_mtime_ns != config_mtime_ns:
+                reload_config()
+        except Exception as e:
+            logger.error(f'config_watch_loop() error: {traceback.format_exc()}')
+
 def get_rest_data(rest_id: str) -> dict:
-    rest_list = config['restaurants']
-    for rest in rest_list:
-        if rest['rest_id'].strip() == rest_id.strip():
-            return rest
+    rest = rest_registry.get(rest_id.strip())
+    if rest:
+        return rest
 
     return {
          "rest_name": "Unknown",
@@ -89,59 +280,787 @@ def get_rest_data(rest_id: str) -> dict:
          "rest_pass": "0000000"
     }
 
+def get_user_rests(user: dict) -> dict:
+    """rest_id -> rest_name of a db entry, entries from before multi-restaurant logins are converted."""
+    if 'rest_id' in user:
+        user.setdefault('rests', {})[user.pop('rest_id')] = user.pop('rest_name', '')
+    return user.setdefault('rests', {})
+
+def rebuild_subs_index():
+    global subs_index
+    new_index = {}
+    for user_id, user in db.items():
+        try:
+            chat_id = int(user_id.replace('u', ''))
+            for rest_id in get_user_rests(user):
+                new_index.setdefault(rest_id, set()).add(chat_id)
+        except Exception as e:
+            logger.error(f'rebuild_subs_index error on {user_id}: {traceback.format_exc()}, continue...')
+    with db_lock:
+        subs_index = new_index
+    logger.info(f'rebuild_subs_index() finished. {len(subs_index)} restaurants have subscribers.')
+
+def add_sub(chat_id: int, user_name: str, rest_id: str, rest_name: str):
+    conn = get_store_db()
+    with conn:
+        conn.execute('INSERT OR REPLACE INTO users (chat_id, name) VALUES (?, ?)', (chat_id, user_name))
+        conn.execute('INSERT OR REPLACE INTO subs (chat_id, rest_id, rest_name) VALUES (?, ?, ?)',
+                     (chat_id, rest_id, rest_name))
+    with db_lock:
+        user = db.setdefault(f'u{chat_id}', {'name': user_name, 'rests': {}})
+        user['name'] = user_name
+        user['rests'][rest_id] = rest_name
+        subs_index.setdefault(rest_id, set()).add(chat_id)
+
+def remove_sub(chat_id: int, rest_id: str):
+    conn = get_store_db()
+    with conn:
+        conn.execute('DELETE FROM subs WHERE chat_id = ? AND rest_id = ?', (chat_id, rest_id))
+    with db_lock:
+        user = db.get(f'u{chat_id}')
+        if user:
+            user['rests'].pop(rest_id, None)
+        subs = subs_index.get(rest_id)
+        if subs is not None:
+            subs.discard(chat_id)
+            if not subs:
+                del subs_index[rest_id]
+
 def get_subs_for_rest(rest_id: str) -> list:
-    subs = []
-    for user in db.keys():
+    with db_lock:
+        return list(subs_index.get(rest_id, ()))
+
+def get_file_part(name: str) -> str:
+    return re.sub(r'[^\w.-]', '_', name)
+
+def save_report_file(rest_id: str, rep_title: str, text: str, ts: datetime) -> str:
+    """Writes the report into the open day of its restaurant, returns the path."""
+    day_dir = os.path.join(ARCHIVE_DIR, get_file_part(rest_id), ts.strftime('%Y-%m-%d'))
+    os.makedirs(day_dir, exist_ok=True)
+    rep_file = f'{ts.strftime("%H-%M-%S")}-{get_file_part(rep_title)}'
+    path = os.path.join(day_dir, f'{rep_file}.txt')
+    i = 0
+    while True:
         try:
-            if db[user]['rest_id'] == rest_id:
-                chat_id = int(user.replace('u', ''))
-                subs.append(chat_id)
+            f = open(path, 'x', encoding='utf-8', newline='')   # Stored as sent, \r and all
+            break
+        except FileExistsError:   # Same report title within one second
+            i += 1
+            path = os.path.join(day_dir, f'{rep_file}-{i}.txt')
+    with f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    return path
+
+def get_doc_name(rest_id: str, rep_title: str, ts: float) -> str:
+    """File name managers see in Telegram."""
+    return f'{rest_id}-{rep_title}-{datetime.fromtimestamp(ts).strftime("%m-%d-%y-%H-%M-%S")}.txt'
+
+def read_archived(archive_id: int) -> tuple:
+    """Returns (doc_name, data) of an archived report, plain file or gzip member of a day segment."""
+    for i in range(2):
+        row = get_store_db().execute('SELECT rest_id, rep_title, ts, path, offset, length FROM archive WHERE id = ?',
+                                     (archive_id,)).fetchone()
+        if row is None:
+            raise Exception(f'Report {archive_id} is not in the archive.')
+        rest_id, rep_title, ts, path, offset, length = row
+        try:
+            with open(path, 'rb') as f:
+                if offset is None:
+                    return get_doc_name(rest_id, rep_title, ts), f.read()
+                f.seek(offset)
+                return get_doc_name(rest_id, rep_title, ts), gzip.decompress(f.read(length))
+        except FileNotFoundError:
+            if i > 0:
+                raise   # Otherwise the day was compacted between the select and the open
+
+def compact_day(rest_id: str, day: str):
+    """Packs the reports of a closed day into one segment of gzip members, then drops the day directory."""
+    conn = get_store_db()
+    rows = conn.execute('SELECT id, path FROM archive WHERE rest_id = ? AND day = ? AND offset IS NULL ORDER BY id',
+                        (rest_id, day)).fetchall()
+    seg_path = os.path.join(ARCHIVE_DIR, get_file_part(rest_id), f'{day}.gz')
+    tmp_path = seg_path + '.tmp'
+    placed = []
+    with open(tmp_path, 'wb') as seg:
+        if os.path.isfile(seg_path):   # Reports that arrived late for an already compacted day
+            with open(seg_path, 'rb') as old_seg:
+                shutil.copyfileobj(old_seg, seg)
+        for archive_id, path in rows:
+            with open(path, 'rb') as f:
+                member = gzip.compress(f.read())
+            placed.append((seg_path, seg.tell(), len(member), archive_id))
+            seg.write(member)
+        seg.flush()
+        os.fsync(seg.fileno())
+    os.replace(tmp_path, seg_path)
+    with conn:
+        conn.executemany('UPDATE archive SET path = ?, offset = ?, length = ? WHERE id = ?', placed)
+    for archive_id, path in rows:
+        os.remove(path)
+    day_dir = os.path.join(ARCHIVE_DIR, get_file_part(rest_id), day)
+    if os.path.isdir(day_dir) and not os.listdir(day_dir):
+        os.rmdir(day_dir)
+    logger.info(f'compact_day() packed {len(rows)} reports of {rest_id} for {day} into {seg_path}.')
+
+def apply_archive_retention():
+    keep_days = config.get('archive_retention_days', ARCHIVE_RETENTION_DAYS)
+    first_day = datetime.fromtimestamp(time.time() - keep_days * 24 * 60 * 60).strftime('%Y-%m-%d')
+    conn = get_store_db()
+    old = conn.execute('SELECT DISTINCT path FROM archive WHERE day < ?', (first_day,)).fetchall()
+    with conn:
+        conn.execute('DELETE FROM archive WHERE day < ?', (first_day,))
+    for (path,) in old:
+        if os.path.isfile(path):
+            os.remove(path)
+    if old:
+        logger.info(f'apply_archive_retention() removed {len(old)} files older than {first_day}.')
+
+def import_legacy_reports():
+    """Moves flat reports/ files into the archive, files of pending deliveries stay until they are sent."""
+    if not os.path.isdir(LEGACY_REPORTS_DIR):
+        return
+    conn = get_store_db()
+    pending = set([row[0] for row in conn.execute('SELECT path FROM deliveries')])
+    imported = 0
+    for file in sorted(os.listdir(LEGACY_REPORTS_DIR)):
+        path = os.path.join(LEGACY_REPORTS_DIR, file)
+        match = re.match(r'^([^-]+)-(.+)-(\d\d-\d\d-\d\d-\d\d-\d\d-\d\d)(-\d+)?\.txt$', file)
+        if not match or path in pending:
+            continue
+        rest_id, rep_title = match.group(1), match.group(2)
+        ts = datetime.strptime(match.group(3), '%m-%d-%y-%H-%M-%S')
+        with open(path, 'r', encoding='utf-8', errors='replace') as f:
+            new_path = save_report_file(rest_id, rep_title, f.read(), ts)
+        with conn:
+            conn.execute('INSERT INTO archive (rest_id, rep_title, ts, day, path) VALUES (?, ?, ?, ?, ?)',
+                         (rest_id, rep_title, ts.timestamp(), ts.strftime('%Y-%m-%d'), new_path))
+        os.remove(path)
+        imported += 1
+    if imported:
+        logger.info(f'import_legacy_reports() moved {imported} reports from {LEGACY_REPORTS_DIR} to {ARCHIVE_DIR}.')
+
+def archive_maintenance():
+    today = datetime.now().strftime('%Y-%m-%d')
+    closed = get_store_db().execute('''SELECT DISTINCT rest_id, day FROM archive
+        WHERE day < ? AND offset IS NULL''', (today,)).fetchall()
+    for rest_id, day in closed:
+        try:
+            compact_day(rest_id, day)
+        except Exception as e:
+            logger.error(f'compact_day({rest_id}, {day}) error: {traceback.format_exc()}')
+    apply_archive_retention()
+
+def prune_incoming():
+    """Drops chunked reports the client stopped sending."""
+    conn = get_store_db()
+    with incoming_lock:
+        stale = conn.execute('SELECT report_id FROM incoming WHERE updated < ?',
+                             (time.time() - INCOMING_STALE_SEC,)).fetchall()
+        for (report_id,) in stale:
+            drop_incoming(report_id)
+    if stale:
+        logger.info(f'prune_incoming() dropped {len(stale)} unfinished chunked reports.')
+
+def archive_loop():
+    while not shutting_down.is_set():
+        try:
+            import_legacy_reports()
+            archive_maintenance()
+            prune_incoming()
+        except Exception as e:
+            logger.error(f'archive_loop() error: {traceback.format_exc()}')
+        shutting_down.wait(ARCHIVE_MAINTENANCE_SEC)
+
+def update_stats():
+    """Feeds archived reports newer than the stats into them, so the archive is their only source."""
+    conn = get_store_db()
+    while True:
+        rows = conn.execute('SELECT id, rest_id FROM archive WHERE id > ? ORDER BY id LIMIT 500',
+                            (shift_stats.last_rep_id,)).fetchall()
+        if not rows:
+            return
+        for archive_id, rest_id in rows:
+            try:
+                doc_name, data = read_archived(archive_id)
+                text = data.decode('utf-8', errors='replace')
+            except Exception as e:
+                logger.error(f'update_stats() can not read report {archive_id}: {traceback.format_exc()}')
+                text = ''   # Skipped, stats must not stop on one report
+            shift_stats.add_report(archive_id, rest_id, text)
+        if shift_stats.get_pending_rows() >= shift_stats.SEGMENT_ROWS:
+            shift_stats.flush()
+
+def stats_loop():
+    if shift_stats.np is None:
+        logger.warning('numpy is not installed, shift report stats are off.')
+        return
+    from_id = shift_stats.open_stats()
+    logger.info(f'Shift report stats loaded up to report {from_id}.')
+    last_flush = time.monotonic()
+    while not shutting_down.is_set():
+        try:
+            update_stats()
+            if time.monotonic() - last_flush > STATS_FLUSH_SEC:
+                shift_stats.flush()
+                last_flush = time.monotonic()
         except Exception as e:
-            logger.error(f'get_subs_for_rest error: {traceback.format_exc()}, continue...')
+            logger.error(f'stats_loop() error: {traceback.format_exc()}')
+        stats_wakeup.wait(STATS_FLUSH_SEC)
+        stats_wakeup.clear()
+    shift_stats.flush()
+
+def find_archived(rest_ids: list, limit: int, from_ts: float = 0, to_ts: float = None) -> list:
+    """Newest first [(id, rest_id, rep_title, ts), ...] of the restaurants within [from_ts, to_ts)."""
+    if not rest_ids:
+        return []
+    marks = ', '.join(['?'] * len(rest_ids))
+    return get_store_db().execute(f'''SELECT id, rest_id, rep_title, ts FROM archive
+        WHERE rest_id IN ({marks}) AND ts >= ? AND ts < ? ORDER BY ts DESC LIMIT ?''',
+        list(rest_ids) + [from_ts, to_ts if to_ts is not None else float('inf'), limit]).fetchall()
+
+def get_report_digest(rest_id: str, rep_title: str, text: str) -> str:
+    """Same as report_digest() of the client."""
+    return hashlib.sha256(f'{rest_id}\0{rep_title}\0{text}'.encode('utf-8')).hexdigest()
+
+def prune_dedup():
+    """Drops digests older than DEDUP_TTL_SEC, then the least recently seen above DEDUP_MAX_ROWS."""
+    conn = get_store_db()
+    with conn:
+        conn.execute('DELETE FROM dedup WHERE seen < ?', (time.time() - DEDUP_TTL_SEC,))
+        conn.execute('''DELETE FROM dedup WHERE digest IN (
+            SELECT digest FROM dedup ORDER BY seen DESC LIMIT -1 OFFSET ?)''', (DEDUP_MAX_ROWS,))
+
+def set_base(conn: sqlite3.Connection, rest_id: str, rep_title: str, digest: str, text: str):
+    conn.execute('INSERT OR REPLACE INTO bases (rest_id, rep_title, digest, text) VALUES (?, ?, ?, ?)',
+                 (rest_id, rep_title, digest, text))
+
+def apply_delta(rest_id: str, rep_title: str, base_digest: str, delta: list) -> str:
+    """Rebuilds a report from the stored base and a line diff of delta_for() of the client.
+
+    delta is [["=", first, end], ["+", text], ...]: copy base lines [first:end), add text.
+    Returns None if the base is not the one the client diffed against.
+    """
+    row = get_store_db().execute('SELECT digest, text FROM bases WHERE rest_id = ? AND rep_title = ?',
+                                 (str(rest_id), rep_title)).fetchone()
+    if row is None or row[0] != base_digest:
+        return None
+    base_lines = row[1].splitlines(keepends=True)
+    parts = []
+    for op in delta:
+        if op[0] == '=':
+            parts.extend(base_lines[op[1]:op[2]])
+        else:
+            parts.append(op[1])
+    return ''.join(parts)
+
+def get_report_text(rest_id: str, rep: dict) -> str:
+    """Full text of a posted report, None if it came as a diff against a base the server does not have."""
+    if 'delta' in rep:
+        return apply_delta(rest_id, f'{rep["rep_title"]}', rep["base_digest"], rep["delta"])
+    return rep["rep_text"]
 
-    return subs
+def skip_duplicate(conn: sqlite3.Connection, rest_id: str, rep_title: str, digest: str, text: str):
+    with conn:
+        conn.execute('UPDATE dedup SET seen = ? WHERE digest = ?', (time.time(), digest))
+        set_base(conn, rest_id, rep_title, digest, text)   # The client takes it as its base too
+    logger.info(f'Duplicate report {rep_title} of {rest_id} skipped.')
 
-def send_to_users(rest_id: str, rep_title: str, text: str):
-    time_now = datetime.now().strftime("%m-%d-%y-%H-%M-%S")
+def ingest_report(rest_id: str, rep_title: str, text: str, digest: str = None) -> bool:
+    """Persists the report and queues its delivery, Telegram is not touched here.
+
+    A report seen before (a retry after a lost answer) is skipped, returns False then.
+    """
+    rest_id = str(rest_id)
+    own_digest = get_report_digest(rest_id, rep_title, text)
+    if digest and digest != own_digest:
+        raise Exception(f'Digest mismatch, report {rep_title} of {rest_id} is damaged.')
+    conn = get_store_db()
+    if conn.execute('SELECT 1 FROM dedup WHERE digest = ?', (own_digest,)).fetchone():
+        skip_duplicate(conn, rest_id, rep_title, own_digest, text)
+        return False
+
+    # The file first, then the dedup, archive and delivery rows in one transaction: a crash in between
+    # leaves a stray file at worst, never a digest without its report.
+    base_title = rep_title
     rep_title = rep_title.replace(' ', '_')
-    rep_file = f'{rest_id}-{rep_title}-{time_now}.txt'
-    path = os.path.join('reports', rep_file)
-    with open(path, 'w') as f:
-        f.write(text)
+    ts = datetime.now()
+    path = save_report_file(rest_id, rep_title, text, ts)
+    try:
+        with conn:
+            is_new = conn.execute('INSERT OR IGNORE INTO dedup (digest, seen) VALUES (?, ?)',
+                                  (own_digest, time.time())).rowcount > 0
+            if is_new:
+                set_base(conn, rest_id, base_title, own_digest, text)
+                archive_id = conn.execute('''INSERT INTO archive (rest_id, rep_title, ts, day, path)
+                    VALUES (?, ?, ?, ?, ?)''', (rest_id, rep_title, ts.timestamp(), ts.strftime('%Y-%m-%d'), path)).lastrowid
+                conn.execute('''INSERT INTO deliveries (rest_id, rep_title, path, next_try, archive_id)
+                    VALUES (?, ?, ?, ?, ?)''', (rest_id, rep_title, path, time.time(), archive_id))
+    except Exception:
+        os.remove(path)
+        raise
+    if not is_new:   # The same report came in on another request meanwhile
+        os.remove(path)
+        skip_duplicate(conn, rest_id, base_title, own_digest, text)
+        return False
+    delivery_wakeup.set()
+    stats_wakeup.set()
+    if next(dedup_inserts) % DEDUP_PRUNE_EVERY == 0:
+        prune_dedup()
+    return True
+
+def new_bucket(per_sec: float, capacity: float) -> dict:
+    return {'rate': per_sec, 'capacity': capacity, 'tokens': capacity, 'updated': time.monotonic(), 'paused_until': 0}
+
+def get_bucket_wait(bucket: dict, now: float) -> float:
+    """Seconds until the bucket has a token, refilling it on the way."""
+    if bucket['paused_until'] > now:
+        return bucket['paused_until'] - now
+    bucket['tokens'] = min(bucket['capacity'], bucket['tokens'] + (now - bucket['updated']) * bucket['rate'])
+    bucket['updated'] = now
+    if bucket['tokens'] >= 1:
+        return 0
+    return (1 - bucket['tokens']) / bucket['rate']
+
+global_bucket = new_bucket(TG_GLOBAL_PER_SEC, TG_GLOBAL_PER_SEC)
+
+def bot_call(priority: int, chat_id: int, fn, *args, **kwargs) -> Future:
+    """Queues a Bot API call behind the global and per-chat rate limits, interactive calls go first."""
+    start_bot_senders()
+    future = Future()
+    with send_cond:
+        heapq.heappush(send_heap, (priority, next(send_seq), chat_id, fn, args, kwargs, future))
+        send_cond.notify()
+    return future
+
+def reply(chat_id: int, text: str):
+    future = bot_call(PRIORITY_INTERACTIVE, chat_id, bot.send_message, chat_id, text)
+    future.add_done_callback(lambda f: f.exception() and logger.warning(f'Can not reply to {chat_id}: {f.exception()}'))
 
-    subs = get_subs_for_rest(rest_id)
+def next_bot_call() -> tuple:
+    with send_cond:
+        while True:
+            now = time.monotonic()
+            wait_sec = get_bucket_wait(global_bucket, now) if send_heap else None
+            if wait_sec == 0:
+                skipped = []
+                picked = None
+                while send_heap:
+                    item = heapq.heappop(send_heap)
+                    bucket = chat_buckets.get(item[2])
+                    if bucket is None:
+                        bucket = chat_buckets[item[2]] = new_bucket(TG_CHAT_PER_SEC, 1)
+                    chat_wait = get_bucket_wait(bucket, now)
+                    if chat_wait == 0:
+                        bucket['tokens'] -= 1
+                        global_bucket['tokens'] -= 1
+                        picked = item
+                        break
+                    skipped.append(item)
+                    wait_sec = chat_wait if not wait_sec else min(wait_sec, chat_wait)
+                for item in skipped:
+                    heapq.heappush(send_heap, item)
+                if picked:
+                    if len(chat_buckets) > 10000:
+                        prune_chat_buckets(now)
+                    return picked
+            send_cond.wait(wait_sec)
+
+def prune_chat_buckets(now: float):
+    for chat_id, bucket in list(chat_buckets.items()):
+        if now - bucket['updated'] > 60 and bucket['paused_until'] < now:
+            del chat_buckets[chat_id]
+
+def bot_send_loop():
+    while True:
+        item = next_bot_call()
+        priority, seq, chat_id, fn, args, kwargs, future = item
+        for arg in args:
+            if hasattr(arg, 'seek'):
+                arg.seek(0)   # A file that was partly read by a call that got 429
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except telebot.apihelper.ApiTelegramException as e:
+            if e.error_code != 429:
+                future.set_exception(e)
+                continue
+            retry_after = e.result_json.get('parameters', {}).get('retry_after', 1)
+            logger.warning(f'Telegram flood limit, chat {chat_id}, retry after {retry_after} sec.')
+            with send_cond:
+                paused_until = time.monotonic() + retry_after
+                global_bucket['paused_until'] = max(global_bucket['paused_until'], paused_until)
+                if chat_id in chat_buckets:
+                    chat_buckets[chat_id]['paused_until'] = paused_until
+                heapq.heappush(send_heap, item)   # Same seq, keeps its place in line
+                send_cond.notify_all()
+        except Exception as e:
+            future.set_exception(e)
+
+def start_bot_senders():
+    with send_cond:
+        if bot_senders:
+            return
+        for i in range(BOT_SEND_WORKERS):
+            thread = threading.Thread(target=bot_send_loop, name=f'bot-send-{i}', daemon=True)
+            bot_senders.append(thread)
+            thread.start()
+
+def is_chat_unreachable(e: Exception) -> bool:
+    """Telegram refused this chat for good: the bot was blocked or kicked, the chat is gone."""
+    if not isinstance(e, telebot.apihelper.ApiTelegramException):
+        return False
+    return e.error_code == 403 or (e.error_code == 400 and 'chat' in str(e.description).lower())
+
+def send_to_users(rest_id: str, rep_title: str, doc_name: str, data: bytes, done_chats: set,
+                  file_id: str = None) -> tuple:
+    """Sends the report to subscribers not in done_chats and adds the ones that got it.
+
+    The file is uploaded once, the other subscribers get the Telegram file_id of that
+    upload through the send scheduler. Chats Telegram refuses for good go to done_chats
+    too, a retry would not help them. Returns (nobody is left, file_id).
+    """
+    subs = [sub_id for sub_id in get_subs_for_rest(rest_id) if sub_id not in done_chats]
     if not subs:
-        logger.warning(f'No subs for {rest_id}')
-        return
+        if not done_chats:
+            logger.warning(f'No subs for {rest_id}')
+        return True, file_id
 
     logger.warning(f'Report will be sent to {len(subs)} subs.')
-    for sub_id in subs:
+    all_sent = True
+    while subs and not file_id:
+        sub_id = subs.pop(0)
         try:
-            doc = open(path, 'rb')
-            bot.send_document(sub_id, doc, caption=rep_title)
-            doc.close()
+            msg = bot_call(PRIORITY_BULK, sub_id, bot.send_document, sub_id, io.BytesIO(data), caption=rep_title,
+                           visible_file_name=doc_name).result()
+            done_chats.add(sub_id)
+            file_id = msg.document.file_id
         except Exception as e:
+            if is_chat_unreachable(e):
+                logger.warning(f'Dropping {sub_id} from this delivery: {e}')
+                done_chats.add(sub_id)
+                continue
             logger.warning(f'Can not send doc to {sub_id}: {traceback.format_exc()}')
+            all_sent = False
 
+    futures = {sub_id: bot_call(PRIORITY_BULK, sub_id, bot.send_document, sub_id, file_id, caption=rep_title)
+               for sub_id in subs}
+    for sub_id, future in futures.items():
+        try:
+            future.result()
+            done_chats.add(sub_id)
+        except Exception as e:
+            if is_chat_unreachable(e):
+                logger.warning(f'Dropping {sub_id} from this delivery: {e}')
+                done_chats.add(sub_id)
+                continue
+            logger.warning(f'Can not send doc to {sub_id}: {traceback.format_exc()}')
+            all_sent = False
+    return all_sent, file_id
+
+def claim_delivery():
+    """Marks the next due delivery as taken, the caller holds delivery_lock."""
+    conn = get_store_db()
+    row = conn.execute('''SELECT id, rest_id, rep_title, path, attempts, done_chats, file_id, archive_id
+        FROM deliveries WHERE claimed = 0 AND next_try <= ? ORDER BY id LIMIT 1''', (time.time(),)).fetchone()
+    if row:
+        with conn:
+            conn.execute('UPDATE deliveries SET claimed = 1 WHERE id = ?', (row[0],))
+    return row
+
+def get_delivery_wait() -> float:
+    next_try = get_store_db().execute('SELECT MIN(next_try) FROM deliveries WHERE claimed = 0').fetchone()[0]
+    if next_try is None:
+        return DELIVERY_IDLE_SEC
+    return min(DELIVERY_IDLE_SEC, max(0, next_try - time.time()))
+
+def deliver(row: tuple):
+    delivery_id, rest_id, rep_title, path, attempts, done_chats, file_id, archive_id = row
+    done_chats = set(json.loads(done_chats))
+    try:
+        if archive_id is None:   # Queued before the archive, the file is in reports/
+            with open(path, 'rb') as f:
+                doc_name, data = os.path.basename(path), f.read()
+        else:
+            doc_name, data = read_archived(archive_id)
+        all_sent, file_id = send_to_users(rest_id, rep_title, doc_name, data, done_chats, file_id)
+    except Exception as e:
+        logger.error(f'deliver() error on {delivery_id}: {traceback.format_exc()}')
+        all_sent = False
+
+    conn = get_store_db()
+    with conn:
+        if all_sent:
+            conn.execute('DELETE FROM deliveries WHERE id = ?', (delivery_id,))
+        else:
+            # Only transient failures are left here (network, Telegram down), they are retried at the capped interval
+            delay = min(DELIVERY_RETRY_MAX_SEC, DELIVERY_RETRY_SEC * 2 ** attempts)
+            conn.execute('''UPDATE deliveries SET claimed = 0, attempts = ?, next_try = ?, done_chats = ?, file_id = ?
+                WHERE id = ?''', (attempts + 1, time.time() + delay, json.dumps(list(done_chats)), file_id,
+                                   delivery_id))
+
+def delivery_loop():
+    global deliveries_active
+    while not shutting_down.is_set():
+        try:
+            with delivery_lock:
+                row = claim_delivery()
+                if row:
+                    deliveries_active += 1
+            if row:
+                try:
+                    deliver(row)
+                finally:
+                    with delivery_lock:
+                        deliveries_active -= 1
+                continue
+            wait_sec = get_delivery_wait()
+        except Exception as e:
+            logger.error(f'delivery_loop() error: {traceback.format_exc()}')
+            wait_sec = DELIVERY_IDLE_SEC
+        delivery_wakeup.wait(wait_sec)
+        delivery_wakeup.clear()
+
+def start_delivery_workers():
+    conn = get_store_db()
+    with conn:
+        # Claims of a previous run that died mid-delivery
+        conn.execute('UPDATE deliveries SET claimed = 0 WHERE claimed = 1')
+    pending = conn.execute('SELECT COUNT(*) FROM deliveries').fetchone()[0]
+    logger.info(f'Starting {DELIVERY_WORKERS} delivery workers, {pending} deliveries pending.')
+    for i in range(DELIVERY_WORKERS):
+        threading.Thread(target=delivery_loop, name=f'delivery-{i}', daemon=True).start()
+
+
+@app.before_request
+def limit_inflight():
+    """Backpressure: past http_max_inflight posts or during shutdown the client is told to come back later."""
+    global http_inflight
+    if request.method != 'POST':
+        return None
+    with http_inflight_cond:
+        if shutting_down.is_set() or http_inflight >= (http_max_inflight or HTTP_MAX_INFLIGHT):
+            return 'Server is busy', 503, {'Retry-After': str(HTTP_RETRY_AFTER_SEC)}
+        http_inflight += 1
+        g.counted = True
+
+@app.teardown_request
+def release_inflight(exc):
+    global http_inflight
+    if g.pop('counted', False):
+        with http_inflight_cond:
+            http_inflight -= 1
+            http_inflight_cond.notify_all()
+
+def get_request_json() -> dict:
+    """Request body as json, gzip bodies are inflated up to MAX_DECOMPRESSED_BYTES."""
+    data = request.get_data()
+    encoding = request.headers.get('Content-Encoding', '').strip().lower()
+    if encoding == 'gzip':
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        try:
+            data = decompressor.decompress(data, MAX_DECOMPRESSED_BYTES + 1)
+        except zlib.error as e:
+            abort(400, f'Bad gzip body: {e}')
+        if len(data) > MAX_DECOMPRESSED_BYTES or decompressor.unconsumed_tail:
+            abort(413, f'Body is larger than {MAX_DECOMPRESSED_BYTES} bytes.')
+    elif encoding not in ('', 'identity'):
+        abort(415, f'Unsupported Content-Encoding {encoding}')
+    elif len(data) > MAX_DECOMPRESSED_BYTES:
+        abort(413, f'Body is larger than {MAX_DECOMPRESSED_BYTES} bytes.')
+    if not data:
+        return None
+    return json.loads(data)
+
+@app.route('/caps', methods=['GET'])
+def get_caps():
+    return jsonify({'content_encodings': ['gzip'], 'max_body_bytes': MAX_DECOMPRESSED_BYTES,
+                    'max_batch_reports': MAX_REPS_PER_BATCH, 'max_chunk_bytes': BYTES_PER_REP,
+                    'max_report_bytes': REPORT_MAX_BYTES, 'delta': True})
 
 @app.route('/send_rep', methods=['POST'])
 def get_rep():
-    print('received json', request.json)
-    json = request.json
+    json = get_request_json()
+    print('received json', json)
     if not json:
         raise Exception('No json in request.')
     rest_id = json["rest_id"]
     #rest_data = get_rest_data(rest_id)
     rep_title = f'{json["rep_title"]}'
-    rep_text = json["rep_text"]
+    rep_text = get_report_text(rest_id, json)
+    if rep_text is None:
+        return jsonify({'need_full': True}), 409
 
-
-    send_to_users(rest_id, rep_title, rep_text)
+    ingest_report(rest_id, rep_title, rep_text, json.get("digest"))
 
     return 'OK'
 
+@app.route('/send_reps', methods=['POST'])
+def get_reps():
+    json = get_request_json()
+    if not json or not isinstance(json.get("reports"), list):
+        raise Exception('No reports in request.')
+    if len(json["reports"]) > MAX_REPS_PER_BATCH:
+        return f'Too many reports, max is {MAX_REPS_PER_BATCH}', 413
+    rest_id = json["rest_id"]
+    logger.info(f'Received batch of {len(json["reports"])} reports from {rest_id}')
+
+    results = []
+    failed_groups = set()   # Parts of one spool file after a failed one wait for its retry
+    for rep in json["reports"]:
+        if rep.get('grp') and rep['grp'] in failed_groups:
+            results.append({'id': rep.get('id'), 'ok': False, 'error': 'Earlier part failed'})
+            continue
+        try:
+            rep_text = get_report_text(rest_id, rep)
+            if rep_text is None:
+                results.append({'id': rep.get('id'), 'ok': False, 'need_full': True})
+                if rep.get('grp'):
+                    failed_groups.add(rep['grp'])
+                continue
+            is_new = ingest_report(rest_id, f'{rep["rep_title"]}', rep_text, rep.get("digest"))
+            results.append({'id': rep.get('id'), 'ok': True, 'dup': not is_new})
+        except Exception as e:
+            logger.error(f'get_reps() error on report {rep.get("id")}: {traceback.format_exc()}')
+            results.append({'id': rep.get('id'), 'ok': False, 'error': str(e)})
+            if rep.get('grp'):
+                failed_groups.add(rep['grp'])
+
+    return jsonify({'results': results})
+
+def get_incoming_path(report_id: str) -> str:
+    return os.path.join(INCOMING_DIR, f'{report_id}.part')
+
+def drop_incoming(report_id: str):
+    """The caller holds incoming_lock."""
+    conn = get_store_db()
+    with conn:
+        conn.execute('DELETE FROM incoming WHERE report_id = ?', (report_id,))
+    if os.path.isfile(get_incoming_path(report_id)):
+        os.remove(get_incoming_path(report_id))
+
+def take_chunk(rest_id: str, report_id: str, rep_title: str, seq: int, total: int, data: str) -> tuple:
+    """Appends chunk seq to the report on disk, ingests the report after the last chunk.
+
+    Returns (http status, next expected seq, done).
+    """
+    conn = get_store_db()
+    with incoming_lock:
+        row = conn.execute('SELECT total, next_seq, bytes FROM incoming WHERE report_id = ?', (report_id,)).fetchone()
+        if row is None:
+            if conn.execute('SELECT 1 FROM dedup WHERE digest = ?', (report_id,)).fetchone():
+                logger.info(f'Duplicate chunked report {rep_title} of {rest_id} skipped.')
+                return 200, total, True
+            if seq != 0:   # Partial report lost, e.g. pruned, the client starts over
+                return 409, 0, False
+            os.makedirs(INCOMING_DIR, exist_ok=True)
+            open(get_incoming_path(report_id), 'wb').close()
+            with conn:
+                conn.execute('''INSERT INTO incoming (report_id, rest_id, rep_title, total, updated)
+                    VALUES (?, ?, ?, ?, ?)''', (report_id, rest_id, rep_title, total, time.time()))
+            row = (total, 0, 0)
+        total, next_seq, size = row
+        if seq != next_seq:   # A resent chunk or a gap, the client continues from next_seq
+            return (200 if seq < next_seq else 409), next_seq, False
+
+        chunk = data.encode('utf-8')
+        if size + len(chunk) > REPORT_MAX_BYTES:
+            drop_incoming(report_id)
+            return 413, 0, False
+        with open(get_incoming_path(report_id), 'ab') as f:
+            f.write(chunk)
+            f.flush()
+            os.fsync(f.fileno())
+        next_seq += 1
+        with conn:
+            conn.execute('UPDATE incoming SET next_seq = ?, bytes = ?, updated = ? WHERE report_id = ?',
+                         (next_seq, size + len(chunk), time.time(), report_id))
+        if next_seq < total:
+            return 200, next_seq, False
+
+        with open(get_incoming_path(report_id), 'rb') as f:
+            text = f.read().decode('utf-8')   # Not text mode, it would turn a lone \r into \n
+        try:
+            ingest_report(rest_id, rep_title, text, report_id)
+        finally:
+            drop_incoming(report_id)   # A damaged report is sent again from the first chunk
+        logger.info(f'Chunked report {rep_title} of {rest_id} complete, {total} chunks.')
+        return 200, next_seq, True
+
+@app.route('/send_chunk', methods=['POST'])
+def get_chunk():
+    json = get_request_json()
+    if not json:
+        raise Exception('No json in request.')
+    report_id = json["report_id"]
+    if not re.match(r'^[0-9a-f]{64}$', report_id):
+        abort(400, 'report_id must be a sha256 hex digest.')
+    if len(json["data"]) > BYTES_PER_REP:
+        abort(413, f'Chunk is larger than {BYTES_PER_REP} characters.')
+    status, next_seq, done = take_chunk(str(json["rest_id"]), report_id, f'{json["rep_title"]}', int(json["seq"]),
+                                        int(json["total"]), json["data"])
+    if status == 413:
+        return f'Report is larger than {REPORT_MAX_BYTES} bytes.', 413
+    return jsonify({'next_seq': next_seq, 'done': done}), status
+
 def run_http_server():
-    app.run(host='0.0.0.0', port=config['port'])
+    global http_server, http_max_inflight
+    if create_server:
+        # Requests wait in the task queue of waitress until a thread is free, so the posts being worked on
+        # are kept below the threads: the spare ones answer the queued posts with 503 right away.
+        threads = config.get('http_threads', HTTP_THREADS)
+        http_max_inflight = max(1, threads - HTTP_SPARE_THREADS)
+        http_server = create_server(app, host='0.0.0.0', port=config['port'], threads=threads,
+                                    connection_limit=config.get('http_connection_limit', HTTP_CONNECTION_LIMIT),
+                                    max_request_body_size=MAX_DECOMPRESSED_BYTES)
+        logger.info(f'Serving http with waitress on port {config["port"]}, {threads} threads, '
+                    f'{http_max_inflight} posts at a time.')
+        http_server.run()   # Returns once close_waitress() has closed every channel
+        http_server.task_dispatcher.shutdown()
+    else:
+        logger.warning('waitress is not installed, serving http with the werkzeug server.')
+        http_server = make_server('0.0.0.0', config['port'], app, threaded=True)
+        http_server.serve_forever()
+
+def close_waitress():
+    """Runs in the loop thread of waitress, closes the listening socket and every connection.
+
+    Closing only the server would leave the loop running for the keep-alive connections
+    the clients hold open.
+    """
+    for channel in list(http_server._map.values()):
+        channel.close()
+
+def shutdown_gracefully():
+    """Stops taking reports, waits for the posts and deliveries in progress and stops the bot.
+
+    Reports that are not delivered yet stay in server.db and go out after the restart.
+    """
+    logger.info('Shutting down, draining in-flight reports...')
+    shutting_down.set()
+    delivery_wakeup.set()
+    stats_wakeup.set()
+    deadline = time.monotonic() + SHUTDOWN_DRAIN_SEC
+    with http_inflight_cond:
+        while http_inflight > 0 and time.monotonic() < deadline:
+            http_inflight_cond.wait(deadline - time.monotonic())
+    while time.monotonic() < deadline:
+        with delivery_lock:
+            if deliveries_active == 0:
+                break
+        time.sleep(0.2)
+    logger.info(f'Drained, {http_inflight} posts and {deliveries_active} deliveries were still running.')
+    if http_server:
+        time.sleep(HTTP_FLUSH_SEC)   # Responses of the drained posts leave the sockets
+        if create_server:
+            http_server.trigger.pull_trigger(close_waitress)
+        else:
+            http_server.shutdown()
+    bot.stop_polling()
+
+def on_stop_signal(signum, frame):
+    if not shutting_down.is_set():
+        threading.Thread(target=shutdown_gracefully, name='shutdown').start()
 
 def try_login(message) -> str:
     split = message.text.split(' ')
@@ -152,69 +1071,213 @@ def try_login(message) -> str:
     user_name = message.chat.username
     rest_id = split[0][1:]
     rest_pass = split[1]
-    rest_list = config['restaurants']
-    found_rest = None
-    rest_name = ''
     logger.info(f'Attempt to login from {user_id}:{user_name} with {message.text}')
-    for rest in rest_list:
-        if rest['rest_id'] == rest_id:
-            if rest['rest_pass'] == rest_pass:
-                rest_name = rest["rest_name"]
-                found_rest = f'{rest_name} : {rest_id}'
-                break
-            else:
-                logger.error(f'Wrong password!')
-                return 'Неверный логин или пароль.'
-
-    if not found_rest:
+    rest = rest_registry.get(rest_id)
+    if not rest:
         return 'Данные не найдены.'
+    if rest['rest_pass'] != rest_pass:
+        logger.error(f'Wrong password!')
+        return 'Неверный логин или пароль.'
+    rest_name = rest["rest_name"]
+    found_rest = f'{rest_name} : {rest_id}'
 
-    if user_id not in db.keys():
-        db[user_id] = {'name': user_name}
-        logger.info(f'DB: key for user {user_id} : {user_name} created.')
-    if rest_id not in db[user_id]:
-        db[user_id].update({'rest_id': rest_id, 'rest_name': rest_name})
-        logger.info(f'DB: user {user_id} subscribed to {rest_id} restaurant.')
-    dump_db()
+    with db_lock:
+        is_subscribed = user_id in db.keys() and rest_id in db[user_id]['rests']
+    if not is_subscribed:
+        add_sub(message.from_user.id, user_name, rest_id, rest_name)
+        logger.info(f'DB: user {user_id} : {user_name} subscribed to {rest_id} restaurant.')
     return f'Вы успешно подключились к ресторану {found_rest}'
 
+def get_user_rests_copy(user_id: str) -> dict:
+    with db_lock:
+        if user_id not in db.keys():
+            return {}
+        return dict(db[user_id]['rests'])
+
+def try_unsubscribe(message) -> str:
+    """/unsub id_объекта drops one restaurant, plain /unsub drops all of them."""
+    user_id = f"u{message.from_user.id}"
+    split = message.text.split(' ')
+    rests = get_user_rests_copy(user_id)
+    if not rests:
+        return 'Подписка пуста.'
+    to_remove = [split[1].strip()] if len(split) > 1 else list(rests.keys())
+    removed = []
+    for rest_id in to_remove:
+        if rest_id in rests:
+            remove_sub(message.from_user.id, rest_id)
+            removed.append(f'{rests[rest_id]} (ID:{rest_id})')
+            logger.info(f'DB: user {user_id} unsubscribed from {rest_id} restaurant.')
+    if not removed:
+        return 'Вы не подписаны на этот объект.'
+    return 'Вы отписались от отчетов ' + ', '.join(removed)
+
+def parse_day(text: str) -> datetime:
+    for day_format in ('%d.%m.%Y', '%d.%m.%y', '%Y-%m-%d'):
+        try:
+            return datetime.strptime(text.strip(), day_format)
+        except ValueError:
+            pass
+    return None
+
+def format_archived(rows: list) -> str:
+    if not rows:
+        return 'Отчетов не найдено.'
+    lines = [f'/rep{archive_id} {datetime.fromtimestamp(ts).strftime("%d.%m.%Y %H:%M")} {rep_title} (ID:{rest_id})'
+             for archive_id, rest_id, rep_title, ts in rows]
+    return '\n'.join(lines)
+
+def get_last_reports(message) -> str:
+    """/last N - the newest reports of the subscribed restaurants."""
+    split = message.text.split(' ')
+    rests = get_user_rests_copy(f"u{message.from_user.id}")
+    if not rests:
+        return 'Подписка пуста.'
+    count = int(split[1]) if len(split) > 1 and split[1].isdigit() else 10
+    return format_archived(find_archived(list(rests.keys()), min(count, LIST_MAX_ROWS)))
+
+def get_reports_for_days(message) -> str:
+    """/reports с [по] - reports of the subscribed restaurants for the days, dates like 31.08.2024."""
+    split = message.text.split(' ')
+    rests = get_user_rests_copy(f"u{message.from_user.id}")
+    if not rests:
+        return 'Подписка пуста.'
+    from_day = parse_day(split[1]) if len(split) > 1 else None
+    to_day = parse_day(split[2]) if len(split) > 2 else from_day
+    if not from_day or not to_day:
+        return 'Используйте комманду\n/reports 01.09.2024 30.09.2024'
+    rows = find_archived(list(rests.keys()), LIST_MAX_ROWS, from_day.timestamp(), to_day.timestamp() + 24 * 60 * 60)
+    return format_archived(rows)
+
+def send_archived_report(message):
+    """/rep<id> from the lists of /last and /reports."""
+    chat_id = message.from_user.id
+    archive_id = message.text.split(' ')[0][len('/rep'):]
+    row = None
+    if archive_id.isdigit():
+        row = get_store_db().execute('SELECT rest_id FROM archive WHERE id = ?', (int(archive_id),)).fetchone()
+    if not row or row[0] not in get_user_rests_copy(f"u{chat_id}"):
+        reply(chat_id, 'Отчет не найден.')
+        return
+    doc_name, data = read_archived(int(archive_id))
+    bot_call(PRIORITY_INTERACTIVE, chat_id, bot.send_document, chat_id, io.BytesIO(data),
+             visible_file_name=doc_name).result()
+
+def get_totals_text(message, by_rest: bool) -> str:
+    """/totals [week] - sums of shift reports per restaurant, /chain [week] - of all subscribed restaurants."""
+    if shift_stats.np is None:
+        return 'Статистика недоступна.'
+    rests = get_user_rests_copy(f"u{message.from_user.id}")
+    if not rests:
+        return 'Подписка пуста.'
+    weekly = 'week' in message.text or 'нед' in message.text
+    totals = shift_stats.get_totals(list(rests.keys()), 'week' if weekly else 'day',
+                                    TOTALS_WEEKS if weekly else TOTALS_DAYS, by_rest)
+    if not totals:
+        return 'Сменных отчетов не найдено.'
+    lines = []
+    for rest_id, start, amount, checks, guests in totals:
+        title = f'{rests[rest_id]} (ID:{rest_id})' if by_rest else 'Все рестораны'
+        if not lines or lines[-1][0] != title:
+            lines.append((title, []))
+        period = f'неделя с {start.strftime("%d.%m.%Y")}' if weekly else start.strftime('%d.%m.%Y')
+        lines[-1][1].append(f'{period}: {amount:.2f} (чеков {checks}, гостей {guests})')
+    return '\n\n'.join([title + '\n' + '\n'.join(rows) for title, rows in lines])
+
 def get_current_user_state(chat: str) -> str:
-    #read_db()
     chat_id = f"u{chat}"
-    print(chat, chat_id, db)
-    try:
-        rest_id = db[chat_id]['rest_id']
-        rest_name = db[chat_id]['rest_name']
-        return f'Вы подписаны на отчеты {rest_name} (ID:{rest_id})'
-    except KeyError as e:
-        print(traceback.format_exc())
+    rests = get_user_rests_copy(chat_id)
+    if not rests:
         return f'Подписка пуста.'
+    rests_str = ', '.join([f'{rest_name} (ID:{rest_id})' for rest_id, rest_name in rests.items()])
+    return f'Вы подписаны на отчеты {rests_str}'
 
 config = read_config()
-bot = telebot.TeleBot(config['bot_token'])
+config_mtime_ns = os.stat(CONFIG_FILE).st_mtime_ns
+rest_registry = build_rest_registry(config)   # rest_id -> restaurant from server.json
+config_reload = threading.Event()
+bot = telebot.TeleBot(config['bot_token'], num_threads=config.get('bot_update_threads', BOT_UPDATE_THREADS))
+# Part of the webhook url and the X-Telegram-Bot-Api-Secret-Token header, set_webhook is called on every start
+webhook_secret = config.get('webhook_secret') or secrets.token_urlsafe(32)
 
 @bot.message_handler(content_types=['text'])
 def get_text_message(message):
     print(f'{message.from_user.id} saying: {message.text}')
     if '/start' in message.text:
-        bot.send_message(message.from_user.id, 'Используйте комманду\n@id_объекта пароль\nчто-бы получать отчеты.')
+        reply(message.from_user.id, 'Используйте комманду\n@id_объекта пароль\nчто-бы получать отчеты.\n'
+                                    '/unsub id_объекта - отписаться.\n'
+                                    '/last 10 - последние отчеты.\n'
+                                    '/reports 01.09.2024 30.09.2024 - отчеты за дни.\n'
+                                    '/totals, /totals week - выручка по дням, неделям.\n'
+                                    '/chain, /chain week - то же по всем ресторанам вместе.')
     elif '@' in message.text:
         resp = try_login(message)
         if resp:
-            bot.send_message(message.from_user.id, resp)
+            reply(message.from_user.id, resp)
     elif '/getalllogs' in message.text:
-        bot.send_message(message.from_user.id, 'Will do')
-        doc = open('logs_server.txt', 'rb')
-        bot.send_document(message.from_user.id, doc, caption='LOGS')
+        reply(message.from_user.id, 'Will do')
+        with open(LOGS_FILE, 'rb') as doc:
+            bot_call(PRIORITY_INTERACTIVE, message.from_user.id,
+                     bot.send_document, message.from_user.id, doc, caption='LOGS').result()
+    elif message.text.startswith('/unsub'):
+        reply(message.from_user.id, try_unsubscribe(message))
+    elif message.text.startswith('/last'):
+        reply(message.from_user.id, get_last_reports(message))
+    elif message.text.startswith('/totals'):
+        reply(message.from_user.id, get_totals_text(message, True))
+    elif message.text.startswith('/chain'):
+        reply(message.from_user.id, get_totals_text(message, False))
+    elif message.text.startswith('/reports'):
+        reply(message.from_user.id, get_reports_for_days(message))
+    elif message.text.startswith('/rep'):
+        send_archived_report(message)
     else:
         resp = get_current_user_state(str(message.from_user.id))
-        bot.send_message(message.from_user.id, resp)
+        reply(message.from_user.id, resp)
+
+@app.route(WEBHOOK_PATH + '<secret>', methods=['POST'])
+def tg_webhook(secret):
+    """Updates pushed by Telegram, handlers run in the worker pool of the bot."""
+    if secret != webhook_secret or request.headers.get('X-Telegram-Bot-Api-Secret-Token') != webhook_secret:
+        abort(403)
+    update = telebot.types.Update.de_json(request.get_data(as_text=True))
+    if update:
+        bot.process_new_updates([update])
+    return 'OK'
+
+def run_bot_updates():
+    """Webhook when server.json has "webhook_url" (public https address of this server), polling otherwise."""
+    webhook_url = config.get('webhook_url')
+    if webhook_url:
+        try:
+            bot.set_webhook(url=webhook_url.rstrip('/') + WEBHOOK_PATH + webhook_secret, secret_token=webhook_secret)
+            logger.info(f'Receiving bot updates with webhook {webhook_url}.')
+            shutting_down.wait()
+            return
+        except Exception as e:
+            logger.error(f'set_webhook() error, falling back to polling: {traceback.format_exc()}')
+    try:
+        bot.remove_webhook()   # Telegram gives no updates to getUpdates while a webhook is set
+    except Exception as e:
+        logger.warning(f'remove_webhook() error: {e}')
+    bot.infinity_polling(none_stop=True)
 
 if __name__ == '__main__':
     logger.info('--------------------')
     logger.info('Report HTTP Server v2 init...')
+    open_store()
     db = read_db()
+    rebuild_subs_index()
 
-    thread = threading.Thread(target=run_http_server)
+    if hasattr(signal, 'SIGHUP'):
+        signal.signal(signal.SIGHUP, lambda signum, frame: config_reload.set())
+    signal.signal(signal.SIGTERM, on_stop_signal)
+    signal.signal(signal.SIGINT, on_stop_signal)
+    threading.Thread(target=config_watch_loop, daemon=True).start()
+    start_delivery_workers()
+    threading.Thread(target=archive_loop, name='archive', daemon=True).start()
+    threading.Thread(target=stats_loop, name='stats', daemon=True).start()
+
+    thread = threading.Thread(target=run_http_server, name='http', daemon=True)
     thread.start()
-    bot.infinity_polling(none_stop=True)
+    run_bot_updates()
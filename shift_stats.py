@@ -0,0 +1,271 @@
+import json
+import os
+import re
+import threading
+from datetime import datetime
+
+try:
+    import numpy as np   # Optional, without it shift reports are not parsed into stats
+except ImportError:
+    np = None
+
+# Rows of shift reports ("сменный отчет") in columns, kept as stats/seg-<first>-<last>.npz segments
+# where first/last are archive ids of the reports in it. Strings (restaurant ids, row names) are
+# stored as codes into stats/strings.json. Each flush adds a small segment, runs of small segments
+# are merged into one of up to SEGMENT_ROWS rows, so the files stay few over years.
+
+STATS_DIR = "stats"
+SEGMENT_ROWS = 20000
+
+KIND_PAYMENT = 0   # Безготівкові розр / Готівка: checks, guests, amount
+KIND_TOTAL = 1     # Всего: checks, guests, amount
+KIND_DISCOUNT = 2  # Скидки / Наценки: checks, guests, amount
+KIND_DELETION = 3  # Удаления: qty (блюд), amount
+KIND_CATEGORY = 4  # Суммы по категориям: amount
+
+COLUMNS = {'rest': 'int32', 'day': 'datetime64[D]', 'shift': 'int32', 'kind': 'int8', 'name': 'int32',
+           'checks': 'int32', 'guests': 'int32', 'qty': 'float32', 'amount': 'float64', 'rep': 'int64'}
+
+DAY_RE = re.compile(r'кассовый день\s+(\d\d\.\d\d\.\d{4})')
+SHIFT_RE = re.compile(r'Смена\s+(\d+)')
+COUNTS_ROW_RE = re.compile(r'^\s*(.*?\S)\s+(\d+)\s+(\d+)\s+(-?\d+\.\d+)\s*$')
+QTY_ROW_RE = re.compile(r'^\s*(.*?\S)\s+(-?\d+\.\d+)\s+(-?\d+\.\d+)\s*$')
+AMOUNT_ROW_RE = re.compile(r'^\s*(.*?\S)\s+(-?\d+\.\d+)\s*$')
+
+stats_lock = threading.Lock()
+strings = []        # code -> string
+string_codes = {}   # string -> code
+columns = {}        # name -> numpy array of the flushed segments
+pending = {}        # name -> list of rows not in a segment yet
+last_rep_id = 0     # Newest archive id taken into the stats
+flushed_rep_id = 0  # Newest archive id in the segments
+segments = []       # (first, last, rows) of the segment files, oldest first
+
+
+def parse_shift_report(text: str) -> dict:
+    """{'day', 'shift', 'rows': [(kind, name, checks, guests, qty, amount), ...]}, None if text is not a shift report."""
+    day_match = DAY_RE.search(text)
+    shift_match = SHIFT_RE.search(text)
+    if not day_match or not shift_match:
+        return None
+
+    rows = []
+    kind = None
+    group = ''
+    for line in text.splitlines():
+        stripped = line.strip()
+        if not stripped or stripped.startswith('---'):
+            continue
+        if 'чеков' in stripped and 'гостей' in stripped:
+            kind = KIND_PAYMENT
+        elif stripped.startswith('Скидки'):
+            kind = KIND_DISCOUNT
+            group = ''
+        elif stripped.startswith('Удаления'):
+            kind = KIND_DELETION
+            group = ''
+        elif stripped.startswith('Суммы по категориям'):
+            kind = KIND_CATEGORY
+        elif kind in (KIND_PAYMENT, KIND_DISCOUNT):
+            match = COUNTS_ROW_RE.match(line)
+            if match:
+                name = match.group(1)
+                row_kind = KIND_TOTAL if kind == KIND_PAYMENT and name == 'Всего' else kind
+                if kind == KIND_DISCOUNT and group:
+                    name = f'{group} / {name}'
+                rows.append((row_kind, name, int(match.group(2)), int(match.group(3)), 0.0, float(match.group(4))))
+            elif kind == KIND_DISCOUNT:
+                group = stripped   # Скидка, Наценка
+        elif kind == KIND_DELETION:
+            match = QTY_ROW_RE.match(line)
+            if match:
+                name = f'{group} {match.group(1)}'.strip()
+                rows.append((kind, name, 0, 0, float(match.group(2)), float(match.group(3))))
+            else:
+                group = stripped.rstrip(':')   # БЛЮДА
+        elif kind == KIND_CATEGORY:
+            match = AMOUNT_ROW_RE.match(line)
+            if match:
+                rows.append((kind, match.group(1), 0, 0, 0.0, float(match.group(2))))
+
+    day = datetime.strptime(day_match.group(1), '%d.%m.%Y').date()
+    return {'day': day, 'shift': int(shift_match.group(1)), 'rows': rows}
+
+
+def get_code(string: str) -> int:
+    """The caller holds stats_lock."""
+    code = string_codes.get(string)
+    if code is None:
+        code = len(strings)
+        strings.append(string)
+        string_codes[string] = code
+    return code
+
+
+def empty_columns() -> dict:
+    return {name: np.array([], dtype=dtype) for name, dtype in COLUMNS.items()}
+
+
+def get_segment_path(first: int, last: int) -> str:
+    return os.path.join(STATS_DIR, f'seg-{first:012d}-{last:012d}.npz')
+
+
+def write_segment(path: str, data: dict):
+    with open(path + '.tmp', 'wb') as f:
+        np.savez_compressed(f, **data)
+    os.replace(path + '.tmp', path)
+
+
+def merge_segments():
+    """Packs runs of neighbouring segments into one while it stays within SEGMENT_ROWS rows.
+
+    The merged file is written before the parts are removed, open_stats() drops parts left
+    over by a crash in between. The caller holds stats_lock.
+    """
+    global segments
+    merged = []
+    group = []
+    for seg in segments + [None]:
+        if seg is not None and sum(rows for first, last, rows in group) + seg[2] <= SEGMENT_ROWS:
+            group.append(seg)
+            continue
+        if len(group) > 1:
+            parts = []
+            for first, last, rows in group:
+                with np.load(get_segment_path(first, last)) as data:
+                    parts.append({name: data[name] for name in COLUMNS})
+            whole = (group[0][0], group[-1][1], sum(rows for first, last, rows in group))
+            write_segment(get_segment_path(whole[0], whole[1]),
+                          {name: np.concatenate([part[name] for part in parts]) for name in COLUMNS})
+            for first, last, rows in group:
+                os.remove(get_segment_path(first, last))
+            group = [whole]
+        merged.extend(group)
+        group = [seg] if seg is not None else []
+    segments = merged
+
+
+def open_stats():
+    """Loads strings and segments, returns the archive id the stats are complete up to."""
+    global last_rep_id, flushed_rep_id, columns, pending, segments
+    os.makedirs(STATS_DIR, exist_ok=True)
+    with stats_lock:
+        strings.clear()
+        string_codes.clear()
+        strings_path = os.path.join(STATS_DIR, 'strings.json')
+        if os.path.isfile(strings_path):
+            with open(strings_path, 'r', encoding='utf-8') as f:
+                for string in json.load(f):
+                    get_code(string)
+        found = []
+        for file in os.listdir(STATS_DIR):
+            match = re.match(r'^seg-(\d+)-(\d+)\.npz$', file)
+            if match:
+                found.append((int(match.group(1)), int(match.group(2))))
+        parts = [empty_columns()]
+        segments = []
+        flushed_rep_id = 0
+        for first, last in sorted(found, key=lambda seg: (seg[0], -seg[1])):
+            if last <= flushed_rep_id:   # Part of a merged segment, left by a crash during the merge
+                os.remove(get_segment_path(first, last))
+                continue
+            with np.load(get_segment_path(first, last)) as seg:
+                parts.append({name: seg[name] for name in COLUMNS})
+            segments.append((first, last, len(parts[-1]['rep'])))
+            flushed_rep_id = last
+        merge_segments()   # Stats written before merging existed have a segment per flush
+        columns = {name: np.concatenate([part[name] for part in parts]) for name in COLUMNS}
+        pending = {name: [] for name in COLUMNS}
+        last_rep_id = flushed_rep_id
+        return last_rep_id
+
+
+def add_report(rep_id: int, rest_id: str, text: str) -> bool:
+    """Appends the rows of a shift report taken from the archive under rep_id. False if it is not a shift report."""
+    global last_rep_id
+    report = parse_shift_report(text)
+    with stats_lock:
+        last_rep_id = max(last_rep_id, rep_id)
+        if not report:
+            return False
+        rest = get_code(rest_id)
+        day = np.datetime64(report['day'], 'D')
+        for kind, name, checks, guests, qty, amount in report['rows']:
+            for column, value in (('rest', rest), ('day', day), ('shift', report['shift']), ('kind', kind),
+                                  ('name', get_code(name)), ('checks', checks), ('guests', guests), ('qty', qty),
+                                  ('amount', amount), ('rep', rep_id)):
+                pending[column].append(value)
+        return True
+
+
+def get_pending_rows() -> int:
+    with stats_lock:
+        return len(pending['rep'])
+
+
+def flush():
+    """Writes the pending rows as a segment, strings first so the segment never has unknown codes."""
+    global columns, pending, flushed_rep_id
+    with stats_lock:
+        if last_rep_id == flushed_rep_id:
+            return
+        new = {name: np.array(values, dtype=COLUMNS[name]) for name, values in pending.items()}
+        strings_path = os.path.join(STATS_DIR, 'strings.json')
+        with open(strings_path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(strings, f, ensure_ascii=False)
+        os.replace(strings_path + '.tmp', strings_path)
+        # An empty segment still records that the reports up to last_rep_id are done
+        write_segment(get_segment_path(flushed_rep_id + 1, last_rep_id), new)
+        segments.append((flushed_rep_id + 1, last_rep_id, len(new['rep'])))
+        columns = {name: np.concatenate([columns[name], new[name]]) for name in COLUMNS}
+        pending = {name: [] for name in COLUMNS}
+        flushed_rep_id = last_rep_id
+        merge_segments()
+
+
+def get_totals(rest_ids: list, period: str, count: int, by_rest: bool = True) -> list:
+    """Sums of the Всего rows per period ('day' or 'week', weeks from Monday) for the last count periods with data.
+
+    A shift reported more than once counts by its newest report. Returns newest first
+    [(rest_id or None, period start date, amount, checks, guests), ...].
+    """
+    with stats_lock:
+        codes = [string_codes[rest_id] for rest_id in rest_ids if rest_id in string_codes]
+        parts = [columns, {name: np.array(values, dtype=COLUMNS[name]) for name, values in pending.items()}]
+    if not codes:
+        return []
+
+    data = {}
+    for part in parts:   # Arrays are replaced on flush, never changed in place, so no lock is needed here
+        mask = (part['kind'] == KIND_TOTAL) & np.isin(part['rest'], codes)
+        for name in ('rest', 'day', 'shift', 'checks', 'guests', 'amount', 'rep'):
+            data.setdefault(name, []).append(part[name][mask])
+    data = {name: np.concatenate(values) for name, values in data.items()}
+
+    rest = data['rest']
+    day = data['day']
+    rep = data['rep']
+    shift_key = rest.astype('int64') << 32 | data['shift'].astype('int64')
+    order = np.lexsort((rep, shift_key))   # Newest report of a shift is the last of its run
+    last = np.ones(len(order), dtype=bool)
+    last[:-1] = shift_key[order][1:] != shift_key[order][:-1]
+    rows = order[last]
+
+    days = day[rows].astype('int64')
+    if period == 'week':
+        days = (days + 3) // 7 * 7 - 3   # 1970-01-01 was a Thursday, move week starts to Monday
+    group_rest = rest[rows].astype('int64') if by_rest else np.zeros(len(rows), dtype='int64')
+    keys, inverse = np.unique(group_rest << 32 | days, return_inverse=True)
+    amount = np.bincount(inverse, weights=data['amount'][rows], minlength=len(keys))
+    checks = np.bincount(inverse, weights=data['checks'][rows], minlength=len(keys))
+    guests = np.bincount(inverse, weights=data['guests'][rows], minlength=len(keys))
+
+    result = []
+    key_rest = keys >> 32
+    for code in np.unique(key_rest):
+        picked = np.nonzero(key_rest == code)[0][::-1][:count]   # Keys are sorted, so by start within a restaurant
+        for i in picked:
+            start = np.datetime64(int(keys[i] & 0xFFFFFFFF), 'D').item()
+            result.append((strings[code] if by_rest else None, start, float(amount[i]), int(checks[i]),
+                           int(guests[i])))
+    return result